@@ -15,12 +15,45 @@
 import sys
 import time
 import datetime
+import multiprocessing
+import concurrent.futures
 import math
 import copy
 import json
 import os.path
+import tempfile
 import urllib.request, urllib.parse, urllib.error
-from xml.etree import ElementTree
+
+try:
+	from lxml import etree as ElementTree  # Optional, C implementation of parser/serializer
+	lxml_available = True
+except ImportError:
+	from xml.etree import ElementTree
+	lxml_available = False
+
+try:
+	from rtree import index as rtree_index  # Optional, for faster spatial searching
+	rtree_available = True
+except ImportError:
+	rtree_available = False
+
+try:
+	import numpy  # Optional, for faster distance computations
+	numpy_available = True
+except ImportError:
+	numpy_available = False
+
+try:
+	from numba import njit  # Optional, for JIT compiled distance kernels (requires numpy)
+	numba_available = numpy_available
+except ImportError:
+	numba_available = False
+
+try:
+	from scipy.spatial import cKDTree  # Optional, for node searching when rtree is not installed (requires numpy)
+	scipy_available = numpy_available
+except ImportError:
+	scipy_available = False
 
 
 version = "3.1.0"
@@ -55,20 +88,24 @@ match_factor = 0.3  # Minimum percent of length of way matched
 new_factor = 0.6    # Ditto for "new" command
 min_nodes = 2       # Min number of nodes in a way to be matched
 
+parallel_threshold = 1000  # Run way matching in parallel processes above this number of ways
+
+index_min_size = 32  # Spatial index not worth building below this number of nodes/ways
+
 
 
 # The following lists are for the replace command:
 
 # Do not merge OSM ways with the folowing highway categories
-avoid_highway = ["path", "bus_stop", "rest_area", "platform", "construction", "proposed"]  # Platform ok for "new" function
+avoid_highway = set(["path", "bus_stop", "rest_area", "platform", "construction", "proposed"])  # Platform ok for "new" function
 
 # Do not merge OSM ways with the following keys
-avoid_tags = ["area", "railway", "piste:type", "snowmobile", "turn:lanes", "turn:lanes:forward", "turn:lanes:backward",
+avoid_tags = frozenset(["area", "railway", "piste:type", "snowmobile", "turn:lanes", "turn:lanes:forward", "turn:lanes:backward",
 			 "destination", "destination:forward", "destination:backward", "destination:ref", "destination:ref:forward", "destination:ref:backward",
-			 "destination:symbol", "destination:symbol:forward", "destination:symbol:backward", "mtb:scale", "class:bicycle:mtb"]
+			 "destination:symbol", "destination:symbol:forward", "destination:symbol:backward", "mtb:scale", "class:bicycle:mtb"])
 
 # Overwrite with the following tags from NVDB when merging ways, including deletion if not present in NVDB (not used by "-tagref" function)
-replace_tags = ["ref", "name", "maxspeed", "oneway", "junction", "foot", "bridge", "tunnel", "layer", "source"]
+replace_tags = frozenset(["ref", "name", "maxspeed", "oneway", "junction", "foot", "bridge", "tunnel", "layer", "source"])
 
 # Do not consider OSM highways of the following types when updating tags
 avoid_highway_tags = ["cycleway", "footway", "steps"]
@@ -88,27 +125,30 @@ replace_highway = []
 # The folloing lists are for the tagref/taglocal commands:
 
 # Include the following tags from NVDB when marking tags in OSM for consideration
-core_tags = ["highway", "ref", "oneway", "lanes", "junction", "name", "maxspeed", "maxheight", "maxweight", "maxlength", "motorroad",
+core_tags = frozenset(["highway", "ref", "oneway", "lanes", "junction", "name", "maxspeed", "maxheight", "maxweight", "maxlength", "motorroad",
 			 "motor_vehicle", "psv", "foot", "bicycle", "agriculatural", "hgv", "cycleway",
-			 "bridge", "tunnel", "layer", "bridge:description", "tunnel:name", "tunnel:description", "turn"]
+			 "bridge", "tunnel", "layer", "bridge:description", "tunnel:name", "tunnel:description", "turn"])
 
 # Include the following suffixes to the core tags above when reporting tags to consider
 tag_suffixes = ["", ":lanes", ":forward", ":backward", ":lanes:forward", ":lanes:backward", ":left", ":right", ":both"]
 
 # Do not update the following tags for the "-tagref" function
-avoid_update_tags = ["ref", "highway", "oneway", "lanes", "surface"]
+avoid_update_tags = frozenset(["ref", "highway", "oneway", "lanes", "surface"])
+
+# Do not update tags containing the following key parts for the "-tagref" function
+avoid_update_suffixes = (":lanes", ":forward", ":backward", ":left", ":right")
 
 # Store progress report for the following tags
-progress_tags = ["highway", "junction", "name", "maxspeed", "maxweight", "maxlength", "motorroad",
-				"motor_vehicle", "psv", "foot", "bicycle", "agricultural", "hgv", "cycleway", "bridge", "tunnel", "layer"]
+progress_tags = frozenset(["highway", "junction", "name", "maxspeed", "maxweight", "maxlength", "motorroad",
+				"motor_vehicle", "psv", "foot", "bicycle", "agricultural", "hgv", "cycleway", "bridge", "tunnel", "layer"])
 
 # The following tags will be deleted
-delete_tags = ["int_ref", "nvdb:id", "nvdb:date", "attribution", "maxspeed:type", "postal_code"]  # Also "source" handled in code
+delete_tags = frozenset(["int_ref", "nvdb:id", "nvdb:date", "attribution", "maxspeed:type", "postal_code"])  # Also "source" handled in code
 
 # The following tags will be deleted if the value is "no"
-delete_negative_tags = ["sidewalk", "sidewalk:both", "sidewalk:left", "sidewalk:right",
+delete_negative_tags = frozenset(["sidewalk", "sidewalk:both", "sidewalk:left", "sidewalk:right",
 						"cycleway", "cycleway:both", "cycleway:right", "cycleway:left",
-						"oneway", "lit", "island:crossing", "tactile_paving", "lane_markings"]
+						"oneway", "lit", "island:crossing", "tactile_paving", "lane_markings"])
 
 # Public highways (national/county) which should not be mixed with other highway classes
 state_highway = ["motorway", "trunk", "primary", "secondary", "motorway_link", "trunk_link", "primary_link", "secondary_link"]  # + "tertiary" included for Sweden
@@ -160,14 +200,32 @@ def open_url (url):
 
 
 
-# Compute approximation of distance between two coordinates, in meters
-# Works for short distances
+# Compute approximation of distance between two coordinates, in meters.
+# Works for short distances. The equirectangular approximation is within a few cm of the
+# haversine/geodesic distance at the 5-15 m margins used for matching within one municipality,
+# so heavier geodesic libraries would not change any matching outcome.
 
 def distance(n1_lat, n1_lon, n2_lat, n2_lon):
 
-	lon1, lat1, lon2, lat2 = map(math.radians, [n1_lon, n1_lat, n2_lon, n2_lat])
-	x = (lon2 - lon1) * math.cos( 0.5*(lat2+lat1) )
-	y = lat2 - lat1
+	# radians() distributes over the differences, so fewer conversions are needed
+	x = math.radians(n2_lon - n1_lon) * math.cos( math.radians( 0.5*(n2_lat + n1_lat) ))
+	y = math.radians(n2_lat - n1_lat)
+	return 6371000 * math.hypot(x, y)
+
+if numba_available:
+	distance = njit(cache=True, fastmath=True, nogil=True)(distance)
+
+
+
+# Compute approximation of distance between two loaded nodes, in meters.
+# Same as distance(), but with radians and cos(lat) precomputed at load time;
+# cos(0.5*(lat1+lat2)) is approximated by the average of the two cosines,
+# which is within the error already accepted by the projection.
+
+def node_distance (n1, n2):
+
+	x = (n2.lon_r - n1.lon_r) * 0.5 * (n1.cos_lat + n2.cos_lat)
+	y = n2.lat_r - n1.lat_r
 	return 6371000 * math.sqrt( x*x + y*y )
 
 
@@ -184,6 +242,26 @@ def line_distance(s1_lat, s1_lon, s2_lat, s2_lon, p3_lat, p3_lon):
 	x2 = x2 * math.cos( y2 )
 	x3 = x3 * math.cos( y3 )
 
+	return projected_line_distance(x1, y1, x2, y2, x3, y3)
+
+
+
+# Compute closest distance from loaded node p3 to line segment [s1, s2] of loaded nodes.
+# Same as line_distance(), but with radians and cos(lat) precomputed at load time.
+
+def line_distance_nodes (s1, s2, p3):
+
+	return projected_line_distance(s1.lon_r * s1.cos_lat, s1.lat_r, \
+									s2.lon_r * s2.cos_lat, s2.lat_r, \
+									p3.lon_r * p3.cos_lat, p3.lat_r)
+
+
+
+# Compute closest distance from point (x3, y3) to line segment [(x1, y1), (x2, y2)].
+# Input is radian coordinates with longitudes already reprojected by cos(lat).
+
+def projected_line_distance (x1, y1, x2, y2, x3, y3):
+
 	A = x3 - x1
 	B = y3 - y1
 	dx = x2 - x1
@@ -197,15 +275,10 @@ def line_distance(s1_lat, s1_lon, s2_lat, s2_lon, p3_lat, p3_lon):
 	else:
 		param = -1
 
-	if param < 0:
-		x4 = x1
-		y4 = y1
-	elif param > 1:
-		x4 = x2
-		y4 = y2
-	else:
-		x4 = x1 + param * dx
-		y4 = y1 + param * dy
+	# Branchless clamp to the segment, then fuse the projection
+	param = 0.0 if param < 0 else (1.0 if param > 1 else param)
+	x4 = x1 + param * dx
+	y4 = y1 + param * dy
 
 	# Also compute distance from p to segment
 
@@ -222,6 +295,9 @@ def line_distance(s1_lat, s1_lon, s2_lat, s2_lon, p3_lat, p3_lon):
 
 	return (lat, lon, distance)
 
+if numba_available:
+	projected_line_distance = njit(cache=True, fastmath=True, nogil=True)(projected_line_distance)
+
 
 
 # Test if line segments s1 and s2 are crossing.
@@ -244,19 +320,168 @@ def crossing_lines (s1, s2):
 	B = s1[0]['lon'] - s2[0]['lon']  # start1.x - start2.x
 
 	r1 = (A * d2x - B * d2y) / D
+	if r1 < 0 or r1 > 1:
+		return False
+
 	r2 = (A * d1x - B * d1y) / D
+	return 0 <= r2 <= 1
+
+
+
+grid_node_size = (0.005, 0.01)  # Grid cell size for node index fallback (lat/lon degrees, ca 500 m)
+grid_way_size = (0.01, 0.02)    # Grid cell size for way index fallback (lat/lon degrees, ca 1 km)
+
+
+
+# Iterate the grid cells covered by the given bounding box
+
+def grid_cells (min_lat, max_lat, min_lon, max_lon, cell_size):
+
+	lat_cell, lon_cell = cell_size
+	for lat in range(int(min_lat // lat_cell), int(max_lat // lat_cell) + 1):
+		for lon in range(int(min_lon // lon_cell), int(max_lon // lon_cell) + 1):
+			yield (lat, lon)
+
+
+
+# Build spatial index of node coordinates; a simple hash grid when rtree is not installed.
+# Returns None if no index could be built (callers will then scan all nodes).
+
+def build_node_index (node_ids):
+
+	node_list = list(node_ids)
+	if len(node_list) < index_min_size:  # Brute force is faster than building an index
+		return None
+
+	if rtree_available:
+		node_idx = rtree_index.Index( (i, (nodes[ node_id ]['lon'], nodes[ node_id ]['lat'], \
+											nodes[ node_id ]['lon'], nodes[ node_id ]['lat']), None) \
+										for i, node_id in enumerate(node_list) )  # Bulk loading is much faster than insert()
+
+		return { 'index': node_idx, 'ids': node_list }
+
+	elif scipy_available:
+		points = numpy.array([ ( nodes[ node_id ]['lat'], nodes[ node_id ]['lon'] ) for node_id in node_list ])
+		return { 'kdtree': cKDTree(points), 'ids': node_list }
+
+	elif numpy_available:
+		return {
+			'coords': ( numpy.array([ nodes[ node_id ]['lat'] for node_id in node_list ]),
+						numpy.array([ nodes[ node_id ]['lon'] for node_id in node_list ]) ),
+			'ids': node_list
+		}
+
+	else:
+		grid = {}
+		for i, node_id in enumerate(node_list):
+			node = nodes[ node_id ]
+			cell = ( int(node['lat'] // grid_node_size[0]), int(node['lon'] // grid_node_size[1]) )
+			if cell not in grid:
+				grid[ cell ] = []
+			grid[ cell ].append(i)
+
+		return { 'grid': grid, 'cell': grid_node_size, 'ids': node_list }
 
-	if r1 < 0 or r1 > 1 or r2 < 0 or r2 > 1:
-		return False
-	'''
-	# Compute intersection point
 
-	x = s1[0]['lon'] + r1 * d1x
-	y = s1[0]['lon'] + r1 * d1y
-	intersection = (x, y)
-	return (intersection)
-	'''
-	return True
+
+# Get nodes within given bounding box from spatial index.
+# Falls back to scanning all given nodes if no index could be built.
+# Callers still need to test the node coordinates exactly (grid cells extend beyond the bounding box).
+
+def get_index_nodes (node_index, all_node_ids, min_lat, max_lat, min_lon, max_lon):
+
+	if node_index is None:
+		return all_node_ids
+
+	elif "index" in node_index:
+		return [ node_index['ids'][i] for i in node_index['index'].intersection((min_lon, min_lat, max_lon, max_lat)) ]
+
+	elif "kdtree" in node_index:
+		# Query the ball circumscribing the bounding box (same lat/lon space as the tree points)
+		center = ( 0.5 * (min_lat + max_lat), 0.5 * (min_lon + max_lon) )
+		radius = 0.5 * math.hypot(max_lat - min_lat, max_lon - min_lon)
+		return [ node_index['ids'][i] for i in node_index['kdtree'].query_ball_point(center, radius) ]
+
+	elif "coords" in node_index:
+		# Branchless containment test against all node coordinates at once
+		node_lats, node_lons = node_index['coords']
+		inside = (node_lats >= min_lat) & (node_lats <= max_lat) & (node_lons >= min_lon) & (node_lons <= max_lon)
+		return [ node_index['ids'][i] for i in numpy.flatnonzero(inside) ]
+
+	else:
+		found = []
+		for cell in grid_cells(min_lat, max_lat, min_lon, max_lon, node_index['cell']):
+			if cell in node_index['grid']:
+				found.extend(node_index['grid'][ cell ])
+		return [ node_index['ids'][i] for i in found ]
+
+
+
+# Build spatial index of way bounding boxes, either an R-tree or NumPy bounding box arrays
+# for a vectorized overlap test. Returns None if neither is available (callers will then scan all ways).
+
+def build_way_index (ways):
+
+	way_list = list(ways.keys())
+	if len(way_list) < index_min_size or not any(ways[ way_id ]['nodes'] for way_id in way_list):
+		return None  # Brute force is faster than building an index
+
+	if rtree_available:
+		way_idx = rtree_index.Index( (i, (ways[ way_id ]['min_lon'], ways[ way_id ]['min_lat'], \
+											ways[ way_id ]['max_lon'], ways[ way_id ]['max_lat']), None) \
+										for i, way_id in enumerate(way_list) \
+										if ways[ way_id ]['nodes'] )  # Bulk loading is much faster than insert()
+
+		return { 'index': way_idx, 'ids': way_list }
+
+	elif numpy_available:
+		return {
+			'bboxes': ( numpy.array([ ways[ way_id ]['min_lat'] for way_id in way_list ]),
+						numpy.array([ ways[ way_id ]['max_lat'] for way_id in way_list ]),
+						numpy.array([ ways[ way_id ]['min_lon'] for way_id in way_list ]),
+						numpy.array([ ways[ way_id ]['max_lon'] for way_id in way_list ]) ),
+			'ids': way_list
+		}
+
+	else:
+		grid = {}
+		for i, way_id in enumerate(way_list):
+			way = ways[ way_id ]
+			if way['nodes']:
+				for cell in grid_cells(way['min_lat'], way['max_lat'], way['min_lon'], way['max_lon'], grid_way_size):
+					if cell not in grid:
+						grid[ cell ] = []
+					grid[ cell ].append(i)
+
+		return { 'grid': grid, 'cell': grid_way_size, 'ids': way_list }
+
+
+
+# Iterate (way_id, way) for ways whose bounding box overlaps the given bounding box.
+# Falls back to iterating all ways if no index could be built.
+# Callers still need to test bounding box overlap exactly.
+
+def get_index_ways (way_index, ways, min_lat, max_lat, min_lon, max_lon):
+
+	if way_index is None:
+		return iter(ways.items())
+
+	elif "index" in way_index:
+		return ((way_index['ids'][i], ways[ way_index['ids'][i] ]) \
+					for i in way_index['index'].intersection((min_lon, min_lat, max_lon, max_lat)))
+
+	elif "bboxes" in way_index:
+		# Branchless overlap test against all bounding boxes at once
+		min_lats, max_lats, min_lons, max_lons = way_index['bboxes']
+		overlap = (min_lats <= max_lat) & (max_lats >= min_lat) & (min_lons <= max_lon) & (max_lons >= min_lon)
+		return ((way_index['ids'][i], ways[ way_index['ids'][i] ]) for i in numpy.flatnonzero(overlap))
+
+	else:
+		found = set()  # Ways may cover several cells
+		for cell in grid_cells(min_lat, max_lat, min_lon, max_lon, way_index['cell']):
+			if cell in way_index['grid']:
+				found.update(way_index['grid'][ cell ])
+		return ((way_index['ids'][i], ways[ way_index['ids'][i] ]) for i in sorted(found))  # Load order, like a full scan
 
 
 
@@ -288,10 +513,20 @@ def get_municipality (parameter):
 
 
 
-# Load dict of all municipalities
+# Load dict of all municipalities.
+# The list is cached locally for a week, so repeat runs (e.g. replace, then new, then tagref)
+# avoid one network request each.
 
 def load_municipalities(country):
 
+	cache_filename = os.path.join(tempfile.gettempdir(), "highway_merge_municipalities_%s.json" % country)
+
+	if os.path.isfile(cache_filename) and time.time() - os.path.getmtime(cache_filename) < 7 * 86400:
+		file = open(cache_filename)
+		municipalities.update(json.load(file))
+		file.close()
+		return
+
 	if country == "Sweden":
 		url = "https://catalog.skl.se/rowstore/dataset/b80d412c-9a81-4de3-a62c-724192295677?_limit=400"
 		file = urllib.request.urlopen(url)
@@ -309,6 +544,67 @@ def load_municipalities(country):
 			for municipality in county['kommuner']:
 				municipalities[ municipality['kommunenummer'] ] = municipality['kommunenavnNorsk']
 
+	file = open(cache_filename, "w")
+	json.dump(municipalities, file, indent=2, ensure_ascii=False)
+	file.close()
+
+
+
+# Node entry with radians and cos(lat) precomputed for the distance functions.
+# Each node also gets a compact integer index into the global coordinate arrays.
+# Slots keep the node table compact; subscripting is supported so node entries
+# can be accessed like the way dicts.
+
+class Node:
+
+	__slots__ = ('xml', 'used', 'lat', 'lon', 'lat_r', 'lon_r', 'cos_lat', 'index')
+
+	def __init__ (self, lat, lon, xml, used):
+		self.xml = xml
+		self.used = used  # Will have a value larger than zero at time of output to avoid deletion
+		self.lat = lat
+		self.lon = lon
+		self.lat_r = math.radians(lat)
+		self.lon_r = math.radians(lon)
+		self.cos_lat = math.cos(self.lat_r)
+		self.index = len(node_latitudes)
+
+	def __getitem__ (self, key):
+		return getattr(self, key)
+
+	def __setitem__ (self, key, value):
+		setattr(self, key, value)
+
+
+def add_node (node_id, lat, lon, xml, used):
+
+	node = Node(lat, lon, xml, used)
+	nodes[ sys.intern(node_id) ] = node
+
+	node_latitudes.append(node.lat_r)
+	node_longitudes.append(node.lon_r)
+	node_projections.append(node.lon_r * node.cos_lat)
+
+
+
+# Get the global node coordinate arrays (radians + projected x), rebuilt after new nodes have been added
+
+def node_arrays ():
+
+	global node_array
+
+	if node_array is None:
+		node_array = ( numpy.array(node_latitudes), numpy.array(node_longitudes), numpy.array(node_projections) )
+
+	elif len(node_array[0]) != len(node_latitudes):
+		# Append only the new tail instead of reconverting all nodes
+		start = len(node_array[0])
+		node_array = ( numpy.concatenate(( node_array[0], node_latitudes[ start : ] )),
+						numpy.concatenate(( node_array[1], node_longitudes[ start : ] )),
+						numpy.concatenate(( node_array[2], node_projections[ start : ] )) )
+
+	return node_array
+
 
 
 # Load OSM or NVDB xml data and build list and dicts for later processing
@@ -321,12 +617,7 @@ def load_xml(root, ways):
 
 	for node in root.iter("node"):
 		if not("action" in node.attrib and node.attrib['action'] == "delete"):
-			nodes[ node.attrib['id'] ] = {
-				'xml': node,
-				'used': 0,  # Will have a value larger than zero at time of output to avoid deletion
-				'lat': float(node.attrib['lat']),
-				'lon': float(node.attrib['lon'])
-			}
+			add_node (node.attrib['id'], float(node.attrib['lat']), float(node.attrib['lon']), node, 0)
 
 			# Remove node tags used by early editors
 			for tag in node.iter("tag"):
@@ -369,68 +660,96 @@ def load_xml(root, ways):
 				ref = tag.attrib['v']
 			tags[ key ] = tag.attrib['v']
 
-		# Iterate nodes to determine if way is complete
-
-		if ways == osm_ways:
-			for node in way.iter("nd"):
-				node_id = node.attrib['ref']
-				if node_id in nodes:
-					nodes[ node_id ]['used'] += 1
-				elif not("action" in node.attrib and node.attrib['action'] == "delete"):
-					incomplete = True
-
 		if "action" in way.attrib and way.attrib['action'] == "delete" or "area" in tags and tags['area'] == "yes":
 			incomplete = True
 
-		# Determine bounding box and length of way
+		# Iterate nodes once to mark use, check completeness and accumulate length/bbox
 
-		if not incomplete:
-			node_tag = way.find("nd")
-			node_id = node_tag.attrib['ref']
+		mark_used = (ways == osm_ways)
+		prev_lat = None
+		prev_entry = None
 
-			min_lat = nodes[ node_id ]['lat']
-			min_lon = nodes[ node_id ]['lon']
-			max_lat = min_lat
-			max_lon = min_lon
-
-			prev_lat = min_lat
-			prev_lon = min_lon
-
-			for node in way.iter("nd"):
-				if not("action" in node.attrib and node.attrib['action'] == "delete"):
+		for node in way.iter("nd"):
+			if "action" in node.attrib and node.attrib['action'] == "delete":
+				continue
 
-					node_id = node.attrib['ref']
-					length += distance(prev_lat, prev_lon, nodes[node_id]['lat'], nodes[node_id]['lon'])
+			node_id = sys.intern(node.attrib['ref'])  # Same object as the node table key; cheaper dict hits
 
-					# Append node and update bbox
+			if node_id not in nodes:
+				incomplete = True
+				continue
 
-					prev_lat = nodes[node_id]['lat']
-					prev_lon = nodes[node_id]['lon']
+			if mark_used:
+				nodes[ node_id ]['used'] += 1
 
-					way_nodes.append(node_id)
+			node_entry = nodes[ node_id ]
+			node_lat = node_entry.lat
+			node_lon = node_entry.lon
 
-					min_lat = min(min_lat, prev_lat)
-					min_lon = min(min_lon, prev_lon)
-					max_lat = max(max_lat, prev_lat)
-					max_lon = max(max_lon, prev_lon)
+			if prev_lat is None:
+				min_lat = node_lat
+				min_lon = node_lon
+				max_lat = node_lat
+				max_lon = node_lon
+			else:
+				length += node_distance(prev_entry, node_entry)  # Precomputed radians/cos, no trig per segment
+				min_lat = min(min_lat, node_lat)
+				min_lon = min(min_lon, node_lon)
+				max_lat = max(max_lat, node_lat)
+				max_lon = max(max_lon, node_lon)
+
+			prev_lat = node_lat
+			prev_entry = node_entry
+			way_nodes.append(node_id)
+
+		if incomplete:
+			length = 0
+			way_nodes = []
+			min_lat = 0.0
+			min_lon = 0.0
+			max_lat = 0.0
+			max_lon = 0.0
 
-		# Note: Sinple reprojection of bounding box to meters
 		ways[ way_id ] = {
 			'xml': way,
 			'highway': highway,
 			'ref': ref,
 			'incomplete': incomplete,
 			'avoid_tag': avoid_match,  # Not used for NVDB
-			'min_lat': min_lat - margin / 111500.0,
-			'max_lat': max_lat + margin / 111500.0,
-			'min_lon': min_lon - margin / (math.cos(math.radians(min_lat)) * 111320.0),
-			'max_lon': max_lon + margin / (math.cos(math.radians(max_lat)) * 111320.0),
+			'min_lat': min_lat,
+			'max_lat': max_lat,
+			'min_lon': min_lon,
+			'max_lon': max_lon,
 			'length': length,
 			'nodes': way_nodes,
 			'tags': tags,
 			'relations': set()  # Not used for NVDB
 		}
 
+	# Expand bounding boxes by matching margin, batching the trig across all ways
+	# Note: Simple reprojection of bounding box to meters
+
+	margin_lat = margin / 111500.0
+
+	if numpy_available and ways:
+		way_list = list(ways.values())
+		lat_bounds = numpy.array([ ( way['min_lat'], way['max_lat'] ) for way in way_list ])
+		lon_margins = margin / (numpy.cos(numpy.radians(lat_bounds)) * 111320.0)  # One trig pass for both bounds
+
+		for i, way in enumerate(way_list):
+			way['min_lat'] -= margin_lat
+			way['max_lat'] += margin_lat
+			way['min_lon'] -= lon_margins[i, 0]
+			way['max_lon'] += lon_margins[i, 1]
+	else:
+		for way in ways.values():
+			# One cos per way; the variation across the bounding box is far below the margin
+			margin_lon = margin / (math.cos(math.radians( 0.5 * (way['min_lat'] + way['max_lat']) )) * 111320.0)
+			way['min_lon'] -= margin_lon
+			way['max_lon'] += margin_lon
+			way['min_lat'] -= margin_lat
+			way['max_lat'] += margin_lat
+
 	# Determine which nodes and ways are used by relation (should be kept)
 
 	if ways == osm_ways:
@@ -475,11 +794,10 @@ def load_files (name_osm):
 			filename_osm += ".osm"
 			request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
 			file = open_url(request)
-			data = file.read()
+			tree_osm = ElementTree.parse(file)  # Parse the stream; avoids holding raw xml and tree at once
 			file.close()
 
-			root_osm = ElementTree.fromstring(data)
-			tree_osm = ElementTree.ElementTree(root_osm)
+			root_osm = tree_osm.getroot()
 
 		else:
 			sys.exit("\n*** Municipality '%s' not found\n\n" % name_osm)
@@ -491,6 +809,9 @@ def load_files (name_osm):
 		else:
 			sys.exit("\n*** File '%s' not found\n\n" % name_osm)
 
+	# Note: The full tree is needed, not an iterparse/clear pass; output_file mutates
+	# and re-serializes the same elements, and nodes/ways keep references into the tree.
+
 	count_osm_roads = load_xml(root_osm, osm_ways)
 	message ("%i highways loaded\n" % count_osm_roads)
 
@@ -503,8 +824,8 @@ def load_files (name_osm):
 		except urllib.error.HTTPError:
 			sys.exit("\n*** File '%s' not available\n\n" % (nvdb_sweden_site + filename_nvdb))
 		message ("Loading file '%s' ... " % filename_nvdb)
-		data = file.read()
-		tree_nvdb = ElementTree.ElementTree(ElementTree.fromstring(data))
+		tree_nvdb = ElementTree.parse(file)  # Parse the stream; avoids holding raw xml and tree at once
+		file.close()
 
 	else:  # Norway
 		full_filename_nvdb = filename_nvdb
@@ -536,70 +857,314 @@ def way_length(way_nodes):
 		prev_node = None
 		for node in way_nodes:
 			if prev_node:
-				way_distance += distance(nodes[prev_node]['lat'], nodes[prev_node]['lon'], \
-											nodes[node]['lat'], nodes[node]['lon'])
+				way_distance += node_distance(nodes[prev_node], nodes[node])
 			prev_node = node
 
 	return way_distance
 
 
 
+# Get cumulative way length in meters per node position, cached on the way.
+# Element i is the length along the way from node 0 to node i.
+
+def way_cumulative_lengths (way):
+
+	if "cum_lengths" not in way or len(way['cum_lengths']) != len(way['nodes']):
+		if numpy_available and len(way['nodes']) > 2:
+			lat_array, lon_array = way_coordinates(way)
+			cos_array = numpy.cos(lat_array)
+			x = (lon_array[1:] - lon_array[:-1]) * 0.5 * (cos_array[1:] + cos_array[:-1])  # Same formula as node_distance
+			y = lat_array[1:] - lat_array[:-1]
+			cum_lengths = [ 0.0 ] + numpy.cumsum(6371000.0 * numpy.hypot(x, y)).tolist()
+		else:
+			cum_lengths = [ 0.0 ]
+			length = 0.0
+			prev_node = way['nodes'][0]
+			for node_id in way['nodes'][1:]:
+				length += node_distance(nodes[ prev_node ], nodes[ node_id ])
+				cum_lengths.append(length)
+				prev_node = node_id
+
+		way['cum_lengths'] = cum_lengths
+		way['repeated_nodes'] = len(set(way['nodes'])) < len(way['nodes'])  # Closed or self-touching way
+
+	return way['cum_lengths']
+
+
+
 # Compute length of way part in metres.
-# Only compute distance between nodes given by index.
+# Only compute distance between nodes given by index (list or set of distinct indices).
+
+def partial_way_length(way, match_index):
+
+	way_nodes = way['nodes']
+
+	if len(way_nodes) < 2 or len(match_index) < 2:
+		return 0.0
 
-def partial_way_length(way_nodes, match_index):
+	cum_lengths = way_cumulative_lengths(way)
 
-	match_nodes = [way_nodes[node] for node in match_index]
+	# Contiguous matches are just a difference of cumulative lengths
+
+	if not way['repeated_nodes']:
+		first_node = min(match_index)
+		last_node = max(match_index)
+		if last_node - first_node == len(match_index) - 1:
+			return cum_lengths[ last_node ] - cum_lengths[ first_node ]
+
+	match_nodes = set(way_nodes[node] for node in match_index)  # Set for O(1) membership tests below
 	way_distance = 0.0
 
-	if len(way_nodes) > 1 and len(match_nodes) > 1:
-		prev_node = None
+	if len(match_nodes) > 1:
+		prev_node = way_nodes[0]
 
-		for node in way_nodes:
+		for i, node in enumerate(way_nodes[1:]):
 			if prev_node in match_nodes and node in match_nodes:
-				way_distance += distance(nodes[prev_node]['lat'], nodes[prev_node]['lon'], \
-										nodes[node]['lat'], nodes[node]['lon'])
+				way_distance += cum_lengths[ i + 1 ] - cum_lengths[ i ]
 			prev_node = node
 
 	return way_distance
 
 
 
+# Get node coordinates of way as NumPy arrays in radians.
+# The arrays are cached on the way and rebuilt whenever the node list has changed length (splits, inserted nodes).
+
+def way_coordinates (way):
+
+	if "coordinates" not in way or len(way['coordinates'][0]) != len(way['nodes']):
+		all_latitudes, all_longitudes, all_projections = node_arrays()
+		node_index = numpy.fromiter((nodes[ node_id ]['index'] for node_id in way['nodes']), \
+									dtype=numpy.int64, count=len(way['nodes']))
+		way['coordinates'] = ( all_latitudes[ node_index ], all_longitudes[ node_index ] )
+		way['projection'] = ( all_projections[ node_index ], way['coordinates'][0] )
+
+	return way['coordinates']
+
+
+
+# Get projected node coordinates of way (x = lon * cos(lat), y = lat, in radians) as NumPy arrays.
+# Cached on the way, so the projection is computed once per way and shared between the forward
+# and the reverse match of every candidate way pair.
+
+def way_projection (way):
+
+	if "projection" not in way or len(way['projection'][0]) != len(way['nodes']):
+		way_coordinates(way)  # Rebuilds the projection along with the coordinates
+
+	return way['projection']
+
+
+
+# Get per-segment start points, deltas and squared lengths of a way as NumPy arrays.
+# These only depend on the way itself, so caching them saves recomputing the same
+# differences for every candidate pair the way takes part in.
+# Cached on the way and invalidated on node-list change like the other per-way arrays.
+
+def way_segment_arrays (way):
+
+	if "segment_arrays" not in way or len(way['segment_arrays'][0]) != len(way['nodes']) - 1:
+		x_way, y_way = way_projection(way)
+		x1 = x_way[:-1]  # Segment start points
+		y1 = y_way[:-1]
+		dx = x_way[1:] - x1
+		dy = y_way[1:] - y1
+		way['segment_arrays'] = ( x1, y1, dx, dy, dx * dx + dy * dy )
+
+	return way['segment_arrays']
+
+
+
+# JIT compiled kernel computing the distance from each node (x_nodes/y_nodes) to the closest
+# segment of the way given by x_way/y_way. Input is projected radian coordinates.
+# Avoids the NumPy intermediate matrix.
+
+if numba_available:
+
+	@njit(cache=True, fastmath=True, nogil=True)
+	def node_distances_kernel (x_nodes, y_nodes, x1_way, y1_way, dx_way, dy_way, len_sq_way):
+
+		segment_count = x1_way.shape[0]
+		min_distances = numpy.empty(x_nodes.shape[0])
+
+		for i in range(x_nodes.shape[0]):
+			x3 = x_nodes[i]
+			y3 = y_nodes[i]
+			min_distance_sq = 1.0e30
+
+			for j in range(segment_count):
+				x1 = x1_way[j]
+				y1 = y1_way[j]
+				dx = dx_way[j]
+				dy = dy_way[j]
+
+				dot = (x3 - x1) * dx + (y3 - y1) * dy
+				len_sq = len_sq_way[j]
+
+				if len_sq != 0:
+					param = dot / len_sq
+				else:
+					param = -1.0
+
+				if param < 0:
+					param = 0.0
+				elif param > 1:
+					param = 1.0
+
+				x = x1 + param * dx - x3
+				y = y1 + param * dy - y3
+				distance_sq = x*x + y*y  # Squared comparison; sqrt only for the final minimum
+
+				if distance_sq < min_distance_sq:
+					min_distance_sq = distance_sq
+
+			min_distances[i] = 6371000.0 * math.sqrt(min_distance_sq)
+
+		return min_distances
+
+
+
+# Find the closest position on way to the given loaded node, vectorized over the way segments.
+# Returns (lat, lon, distance, node_position) with node_position the index of the segment's
+# end node within the way, like the scalar scans.
+
+def closest_way_point_numpy (way, node):
+
+	x1, y1, dx, dy, len_sq = way_segment_arrays(way)
+	x3 = node.lon_r * node.cos_lat
+	y3 = node.lat_r
+
+	dot = (x3 - x1) * dx + (y3 - y1) * dy
+	param = numpy.divide(dot, len_sq, out=numpy.full_like(dot, -1.0), where=(len_sq != 0))
+	param = numpy.clip(param, 0.0, 1.0)
+
+	x4 = x1 + param * dx
+	y4 = y1 + param * dy
+	distance_sq = (x4 - x3) ** 2 + (y4 - y3) ** 2
+	best = int(distance_sq.argmin())
+
+	best_distance = 6371000.0 * math.sqrt(distance_sq[ best ])
+	lat = math.degrees(y4[ best ])
+	lon = math.degrees(x4[ best ] / math.cos(y4[ best ]))
+	return (lat, lon, best_distance, best + 1)
+
+
+
+# Compute distance from each node in way1[start_node:end_node+1] to the closest segment of way2.
+# Vectorized with NumPy; computes the full node x segment distance matrix in C instead of
+# calling line_distance per pair in the interpreter.
+# Returns (distances, gap_tests) like way_node_distances.
+
+def way_node_distances_numpy (way1, way2, start_node, end_node):
+
+	x_way1, y_way1 = way_projection(way1)
+	x1, y1, dx, dy, len_sq = way_segment_arrays(way2)
+
+	x3 = x_way1[ start_node : end_node + 1][:, None]  # Way 1 nodes
+	y3 = y_way1[ start_node : end_node + 1][:, None]
+
+	dot = (x3 - x1) * dx + (y3 - y1) * dy
+
+	param = numpy.divide(dot, len_sq, out=numpy.full_like(dot, -1.0), where=(len_sq != 0))
+	param = numpy.clip(param, 0.0, 1.0)
+
+	x4 = x1 + param * dx
+	y4 = y1 + param * dy
+	distance_sq = (x4 - x3) ** 2 + (y4 - y3) ** 2  # Squared comparison; sqrt only for the row minima
+
+	best_segment = distance_sq.argmin(axis=1)
+	node_range = numpy.arange(distance_sq.shape[0])
+	min_distances = 6371000.0 * numpy.sqrt(distance_sq[ node_range, best_segment ])  # In meters
+
+	if debug_gap:
+		best_x4 = x4[ node_range, best_segment ]
+		best_y4 = y4[ node_range, best_segment ]
+		gap_tests = []
+		for i, min_node_distance in enumerate(min_distances.tolist()):
+			node1 = nodes[ way1['nodes'][ i + start_node ] ]
+			gap_tests.append({
+				'lat1': node1['lat'],
+				'lon1': node1['lon'],
+				'lat2': math.degrees(best_y4[i]),
+				'lon2': math.degrees(best_x4[i] / math.cos(best_y4[i])),
+				'distance': min_node_distance
+			})
+		return min_distances.tolist(), gap_tests
+	else:
+		return min_distances.tolist(), None
+
+
+
+# Compute distance from each node in way1[start_node:end_node+1] to the closest segment of way2.
+# Distances of at least margin are capped at margin (callers only use distances below margin).
+# With any_match, stop scanning a node's segments at the first distance below margin; the reported
+# distance is then not necessarily the minimum, only guaranteed to be below margin.
+# Returns (distances, gap_tests), one entry per node; gap_tests is None unless debug_gap is set.
+
+def way_node_distances (way1, way2, start_node, end_node, margin, any_match = False):
+
+	if numba_available and not debug_gap and len(way2['nodes']) > 1:
+		x_way1, y_way1 = way_projection(way1)
+		x1, y1, dx, dy, len_sq = way_segment_arrays(way2)
+		min_distances = node_distances_kernel(x_way1[ start_node : end_node + 1], y_way1[ start_node : end_node + 1], \
+												x1, y1, dx, dy, len_sq)
+		return min_distances.tolist(), None
+
+	if numpy_available and len(way2['nodes']) > 1:
+		return way_node_distances_numpy(way1, way2, start_node, end_node)
+
+	node_distances = []
+	gap_tests = [] if debug_gap else None
+
+	for node1 in way1['nodes'][ start_node : end_node + 1]:
+		min_node_distance = margin
+		gap_test = None
+
+		prev_node2 = way2['nodes'][0]
+		for node2 in way2['nodes'][1:]:
+			line_lat, line_lon, gap_distance = line_distance_nodes(nodes[prev_node2], nodes[node2], nodes[node1])
+
+			if gap_distance < min_node_distance:
+				min_node_distance = gap_distance
+
+				if debug_gap:
+					gap_test = {
+						'lat1': nodes[node1]['lat'],
+						'lon1': nodes[node1]['lon'],
+						'lat2': line_lat,
+						'lon2': line_lon,
+						'distance': gap_distance
+					}
+
+				if any_match:
+					break  # Within margin is sufficient, no need to find the minimum
+
+			prev_node2 = node2
+
+		node_distances.append(min_node_distance)
+		if debug_gap:
+			gap_tests.append(gap_test)
+
+	return node_distances, gap_tests
+
+
+
 # Compare part of way 1 with way 2 to determine if they match.
 # Include only segments of the ways which are closer than margin parameter.
 # Return average distance of matched nodes + index of matched nodes.
 
-def match_ways (way1, way2, start_node, end_node, margin, trim_end = False):
+def match_ways (way1, way2, start_node, end_node, margin, trim_end = False, any_match = False):
 
 	way_distance = 0.0
 	count_distance = 0
 	match_nodes = []
 	match_distances = []
 
-	# Iterate all nodes in way1 and identify distance from node to way2
+	# Identify distance from each node in way1 to way2
 
-	for i, node1 in enumerate(way1['nodes'][ start_node : end_node + 1]):
-		min_node_distance = margin
+	node_distances, gap_tests = way_node_distances(way1, way2, start_node, end_node, margin, any_match)
 
-		prev_node2 = way2['nodes'][0]
-		for node2 in way2['nodes'][1:]:
-			line_lat, line_lon, node_distance = line_distance(nodes[prev_node2]['lat'], nodes[prev_node2]['lon'], \
-													nodes[node2]['lat'], nodes[node2]['lon'], \
-													nodes[node1]['lat'], nodes[node1]['lon'])
-
-			if node_distance < min_node_distance:
-				min_node_distance = node_distance
-				min_node_ref = node1
-
-				gap_test = {
-					'lat1': nodes[node1]['lat'],
-					'lon1': nodes[node1]['lon'],
-					'lat2': line_lat,
-					'lon2': line_lon,
-					'distance': node_distance
-				}
-
-			prev_node2 = node2
+	for i, min_node_distance in enumerate(node_distances):
 
 		# Include node in matched nodes list if closer distance than margin
 
@@ -610,7 +1175,7 @@ def match_ways (way1, way2, start_node, end_node, margin, trim_end = False):
 			match_distances.append(min_node_distance)
 
 			if debug_gap:
-				test_lines.append(gap_test)
+				test_lines.append(gap_tests[i])
 
 	# Remove runoff nodes at each end
 
@@ -624,15 +1189,19 @@ def match_ways (way1, way2, start_node, end_node, margin, trim_end = False):
 				test_distances.reverse()
 
 			end_length = 0
+			trim = 0
 
-			while test_distances[0] > 0.5 * margin and len(test_distances) > 1:  # and test_distances[1] < test_distances[0]:
-				node = nodes[ way1['nodes'][ test_nodes[1] ]]
-				last_node = nodes[ way1['nodes'][ test_nodes[0] ]]
-				end_length += distance(last_node['lat'], last_node['lon'], node['lat'], node['lon'])
+			while test_distances[ trim ] > 0.5 * margin and len(test_distances) - trim > 1:  # and test_distances[1] < test_distances[0]:
+				node = nodes[ way1['nodes'][ test_nodes[ trim + 1 ] ]]
+				last_node = nodes[ way1['nodes'][ test_nodes[ trim ] ]]
+				end_length += node_distance(last_node, node)
 				if end_length > margin:
 					break
-				test_distances.pop(0)
-				test_nodes.pop(0)
+				trim += 1
+
+			if trim > 0:
+				del test_nodes[ : trim ]
+				del test_distances[ : trim ]
 
 			if backward:
 				test_nodes.reverse()
@@ -657,10 +1226,78 @@ def match_ways (way1, way2, start_node, end_node, margin, trim_end = False):
 
 
 
+# Check if the given OSM and NVDB highway classes may be matched with each other.
+# The few distinct highway value pairs are cached, replacing the chained list scans
+# with one dict hit in the candidate loop.
+
+highway_compat = {}
+
+def compatible_highways (osm_highway, nvdb_highway):
+
+	pair = (osm_highway, nvdb_highway)
+	if pair not in highway_compat:
+
+		# Avoid mixing pedestrian and car highways
+		compat = not (nvdb_highway in pedestrian_highway and osm_highway not in pedestrian_highway + ["track"] or \
+						nvdb_highway not in pedestrian_highway and osm_highway in pedestrian_highway)
+
+		# Avoid mixing trunk etc with lower highway classes
+		compat = compat and not (nvdb_highway in state_highway and osm_highway not in state_highway + ['tertiary'] or \
+						osm_highway in state_highway and nvdb_highway not in state_highway + ['road', 'tertiary'])
+
+		highway_compat[ pair ] = compat
+
+	return highway_compat[ pair ]
+
+
+
+# Find the best matching NVDB way for one OSM way (pass 1 of merge_highways).
+# Only reads the global data structures, so it may run in a worker process.
+# Returns (osm_id, best_id, best_distance).
+
+def match_osm_way (osm_id):
+
+	osm_way = osm_ways[ osm_id ]
+	best_id = None
+	best_distance = 99999.0
+
+	for nvdb_id, nvdb_way in get_index_ways(nvdb_way_index, nvdb_ways, \
+								osm_way['min_lat'], osm_way['max_lat'], osm_way['min_lon'], osm_way['max_lon']):
+
+		# Avoid ways with no overlapping bbox or with incompatible relative lengths
+		if nvdb_way['min_lat'] <= osm_way['max_lat'] and nvdb_way['max_lat'] >= osm_way['min_lat'] and \
+			nvdb_way['min_lon'] <= osm_way['max_lon'] and nvdb_way['max_lon'] >= osm_way['min_lon'] and \
+			osm_way['length'] > match_factor * nvdb_way['length'] and nvdb_way['length'] > match_factor * osm_way['length']:
+
+			# Avoid mixing incompatible highway classes (pedestrian vs car, trunk vs lower classes)
+			if not compatible_highways(osm_way['highway'], nvdb_way['highway']):
+				continue
+
+			# Check if match between OSM and NVDB way, and determine if closest distance between them
+
+			match_distance, match_nodes = match_ways(nvdb_way, osm_way, 0, len(nvdb_way['nodes']) - 1, margin)
+			if len(match_nodes) >= min_nodes and match_distance < best_distance and \
+					partial_way_length(nvdb_way, match_nodes) > match_factor * nvdb_way['length']:
+
+				# Also check reverse match. Only node membership below margin matters here
+				# (the average is just tested against margin), so first hit per node is enough.
+				reverse_distance, reverse_nodes = match_ways(osm_way, nvdb_way, 0, len(osm_way['nodes']) - 1, margin, \
+																any_match = True)
+				if len(reverse_nodes) >= min_nodes and reverse_distance < margin and \
+						partial_way_length(osm_way, reverse_nodes) > match_factor * osm_way['length']:
+					best_id = nvdb_id
+					best_distance = match_distance
+
+	return (osm_id, best_id, best_distance)
+
+
+
 # Merge NVDB and OSM highways for the commands "replace", "offset" and "tag"
 
 def merge_highways(command):
 
+	global nvdb_way_index
+
 	message ("Merge highways ...\n")
 
 	count = count_osm_roads
@@ -670,76 +1307,61 @@ def merge_highways(command):
 	# Pass 1: Match topology
 	# Iterate OSM ways to identify best match with NVDB way
 
-	for osm_id, osm_way in iter(osm_ways.items()):
-
-		if not osm_way['incomplete'] and osm_way['highway'] != None and osm_way['highway'] not in avoid_highway:
-
-			message ("\r%i " % count)
-			count -= 1
-
-			best_id = None
-			best_distance = 99999.0
-
-			for nvdb_id, nvdb_way in iter(nvdb_ways.items()):
-
-				# Avoid ways with no overlapping bbox or with incompatible relative lengths
-				if nvdb_way['min_lat'] <= osm_way['max_lat'] and nvdb_way['max_lat'] >= osm_way['min_lat'] and \
-					nvdb_way['min_lon'] <= osm_way['max_lon'] and nvdb_way['max_lon'] >= osm_way['min_lon'] and \
-					osm_way['length'] > match_factor * nvdb_way['length'] and nvdb_way['length'] > match_factor * osm_way['length']:
-
-					# Avoid mixing pedestrian and car highways
-					if nvdb_way['highway'] in pedestrian_highway and osm_way['highway'] not in pedestrian_highway + ["track"] or \
-						nvdb_way['highway'] not in pedestrian_highway and osm_way['highway'] in pedestrian_highway:
-						continue
-
-					# Avoid mixing trunk etc with lower highway classes
-					if nvdb_way['highway'] in state_highway and osm_way['highway'] not in state_highway + ['tertiary'] or \
-						osm_way['highway'] in state_highway and nvdb_way['highway'] not in state_highway + ['road', 'tertiary']:
-						continue
+	nvdb_way_index = build_way_index(nvdb_ways)
 
-					# Check if match between OSM and NVDB way, and determine if closest distance between them
+	match_ids = [ osm_id for osm_id, osm_way in iter(osm_ways.items()) \
+					if not osm_way['incomplete'] and osm_way['highway'] != None and osm_way['highway'] not in avoid_highway ]
 
-					match_distance, match_nodes = match_ways(nvdb_way, osm_way, 0, len(nvdb_way['nodes']) - 1, margin)
-					if len(match_nodes) >= min_nodes and match_distance < best_distance and \
-							partial_way_length(nvdb_way['nodes'], match_nodes) > match_factor * nvdb_way['length']:
+	# Distribute the matching over worker processes when possible; the matching itself is
+	# read-only and results are consumed in input order, so the outcome equals a serial run.
+	# Requires fork so workers inherit the loaded data structures.
 
-						# Also check reverse match
-						reverse_distance, reverse_nodes = match_ways(osm_way, nvdb_way, 0, len(osm_way['nodes']) - 1, margin)
-						if len(reverse_nodes) >= min_nodes and reverse_distance < margin and \
-								partial_way_length(osm_way['nodes'], reverse_nodes) > match_factor * osm_way['length']:
-							best_id = nvdb_id
-							best_distance = match_distance
+	if "fork" in multiprocessing.get_all_start_methods() and not debug_gap and len(match_ids) > parallel_threshold:
+		executor = concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork"))
+		chunk = max(10, len(match_ids) // (multiprocessing.cpu_count() * 8))  # A few chunks per worker for load balancing
+		match_results = executor.map(match_osm_way, match_ids, chunksize=chunk)
+	else:
+		executor = None
+		match_results = map(match_osm_way, match_ids)
 
-			# Store match in data structure, if any match
+	for osm_id, best_id, best_distance in match_results:
 
-			if best_id is not None:
-				if command in ["replace", "offset"]:
+		message ("\r%i " % count)
+		count -= 1
 
-					# Replace earlier match if new match is better
+		# Store match in data structure, if any match
 
-					if "osm_id" in nvdb_ways[ best_id ] and nvdb_ways[ best_id ]['distance'] > best_distance:
-						count_swap -= 1
-						total_distance -= nvdb_ways[ best_id ]['distance']
-						del osm_ways[ nvdb_ways[ best_id ]['osm_id'] ]['nvdb_id']
-						del nvdb_ways[ best_id ]['osm_id']
+		if best_id is not None:
+			if command in ["replace", "offset"]:
 
-					if "osm_id" not in nvdb_ways[ best_id ]:
-						count_swap += 1
-						total_distance += best_distance
-						osm_ways[ osm_id ]['nvdb_id'] = best_id
-						nvdb_ways[ best_id ]['osm_id'] = osm_id
-						nvdb_ways[ best_id ]['order'] = count_swap  # Debug
-						nvdb_ways[ best_id ]['distance'] = best_distance  # Debug
+				# Replace earlier match if new match is better
 
-					elif merge_all:
-						osm_ways[ osm_id ]['remove'] = True  # Remove redundant way if it got a match
+				if "osm_id" in nvdb_ways[ best_id ] and nvdb_ways[ best_id ]['distance'] > best_distance:
+					count_swap -= 1
+					total_distance -= nvdb_ways[ best_id ]['distance']
+					del osm_ways[ nvdb_ways[ best_id ]['osm_id'] ]['nvdb_id']
+					del nvdb_ways[ best_id ]['osm_id']
 
-				elif command == "tag":
+				if "osm_id" not in nvdb_ways[ best_id ]:
 					count_swap += 1
 					total_distance += best_distance
 					osm_ways[ osm_id ]['nvdb_id'] = best_id
-					osm_ways[ osm_id ]['order'] = count_swap  # Debug
-					osm_ways[ osm_id ]['distance'] = best_distance  # Debug
+					nvdb_ways[ best_id ]['osm_id'] = osm_id
+					nvdb_ways[ best_id ]['order'] = count_swap  # Debug
+					nvdb_ways[ best_id ]['distance'] = best_distance  # Debug
+
+				elif merge_all:
+					osm_ways[ osm_id ]['remove'] = True  # Remove redundant way if it got a match
+
+			elif command == "tag":
+				count_swap += 1
+				total_distance += best_distance
+				osm_ways[ osm_id ]['nvdb_id'] = best_id
+				osm_ways[ osm_id ]['order'] = count_swap  # Debug
+				osm_ways[ osm_id ]['distance'] = best_distance  # Debug
+
+	if executor is not None:
+		executor.shutdown()
 
 	# Pass 2: Match type highway
 	# Remove matches to be avoided before output
@@ -747,7 +1369,7 @@ def merge_highways(command):
 	if command == "offset":
 		for nvdb_id, nvdb_way in iter(nvdb_ways.items()):
 			if "osm_id" in nvdb_way and (nvdb_way['distance'] < margin_offset or osm_ways[ nvdb_way['osm_id'] ]['highway'] in avoid_highway or \
-					replace_highway and (osm_way['highway'] not in replace_highway or nvdb_ways[ osm_way['nvdb_id'] ]['highway'] not in replace_highway)):
+					replace_highway and (osm_ways[ nvdb_way['osm_id'] ]['highway'] not in replace_highway or nvdb_way['highway'] not in replace_highway)):
 				count_swap -= 1
 				total_distance -= nvdb_way['distance']				
 				del nvdb_ways[ nvdb_id ]['osm_id']
@@ -793,6 +1415,11 @@ def add_new_highways():
 
 	# Iterate NVDB ways to check if match with any OSM way.
 	# Does not identify the best match, but checks how many nodes have a match with any highway.
+	# Index only the OSM ways which can match; the class tests then leave the candidate loop.
+
+	eligible_osm_ways = { osm_id: osm_way for osm_id, osm_way in iter(osm_ways.items()) \
+							if not osm_way['incomplete'] and osm_way['highway'] != None and osm_way['highway'] not in avoid_highway }
+	osm_way_index = build_way_index(eligible_osm_ways)
 
 	for nvdb_id, nvdb_way in iter(nvdb_ways.items()):
 		message ("\r%i " % count)
@@ -803,21 +1430,31 @@ def add_new_highways():
 
 		match_nodes = set()
 
-		for osm_id, osm_way in iter(osm_ways.items()):
+		for osm_id, osm_way in get_index_ways(osm_way_index, eligible_osm_ways, \
+									nvdb_way['min_lat'], nvdb_way['max_lat'], nvdb_way['min_lon'], nvdb_way['max_lon']):
 
 			# Avoid testing ways with no overlapping bbox
-			if not osm_way['incomplete'] and osm_way['highway'] != None and osm_way['highway'] not in avoid_highway and \
-				osm_way['min_lat'] <= nvdb_way['max_lat'] and osm_way['max_lat'] >= nvdb_way['min_lat'] and \
+			if osm_way['min_lat'] <= nvdb_way['max_lat'] and osm_way['max_lat'] >= nvdb_way['min_lat'] and \
 				osm_way['min_lon'] <= nvdb_way['max_lon'] and osm_way['max_lon'] >= nvdb_way['min_lon']:
 
-				test_distance, test_match_nodes = match_ways(nvdb_way, osm_way, 0, len(nvdb_way['nodes']) - 1, margin_new)
+			# Shrink the scanned range to the part which still has unmatched nodes
+
+				start_node = 0
+				end_node = len(nvdb_way['nodes']) - 1
+				while start_node in match_nodes:
+					start_node += 1
+				while end_node in match_nodes:
+					end_node -= 1
+
+				test_distance, test_match_nodes = match_ways(nvdb_way, osm_way, start_node, end_node, margin_new, \
+																any_match = True)  # Only membership below margin is used here
 				match_nodes.update(test_match_nodes)
 
 			if len(match_nodes) == len(nvdb_way['nodes']):  # Break if all nodes already have match
 				break
 
 		# Include way as missing if matching partitions are not long enough
-		match_length = partial_way_length(nvdb_way['nodes'], match_nodes)
+		match_length = partial_way_length(nvdb_way, match_nodes)
 		if match_length < new_factor * nvdb_way['length']:
 			nvdb_ways[ nvdb_id ]['missing'] = "%i" % match_length
 			count_missing += 1
@@ -826,23 +1463,83 @@ def add_new_highways():
 
 
 
-# Find which node in a way which is closest to another given node 
+# Find which node in a way which is closest to another given node.
+# Results are cached on the way; adjacent NVDB ways share end nodes, so the same
+# target is often queried against the same segment. Invalidated on node-list change
+# like the other per-way caches.
 
 def closest_node(way, target_node):
 
-	best_node_gap = margin
-	best_node = None
+	cache = way.get('closest_nodes')
+	if cache is None or cache[0] != len(way['nodes']):
+		cache = ( len(way['nodes']), {} )
+		way['closest_nodes'] = cache
 
-	for i, node in enumerate(way['nodes']):
-		test_gap = distance(nodes[ node ]['lat'], nodes[ node ]['lon'], nodes[ target_node ]['lat'], nodes[ target_node ]['lon'])
-		if test_gap < best_node_gap:
-			best_node_gap = test_gap
-			best_node = i
+	if target_node in cache[1]:
+		return cache[1][ target_node ]
 
+	best_node = None
+	target_entry = nodes[ target_node ]
+
+	if numpy_available and len(way['nodes']) > 2:
+		lat_array, lon_array = way_coordinates(way)
+		x = (lon_array - target_entry.lon_r) * 0.5 * (numpy.cos(lat_array) + target_entry.cos_lat)  # Same formula as node_distance
+		y = lat_array - target_entry.lat_r
+		gaps = 6371000.0 * numpy.hypot(x, y)
+		candidate = int(gaps.argmin())  # First strict minimum, like the scalar scan
+		if gaps[ candidate ] < margin:
+			best_node = candidate
+	else:
+		best_node_gap = margin
+		for i, node in enumerate(way['nodes']):
+			test_gap = node_distance(nodes[ node ], target_entry)
+			if test_gap < best_node_gap:
+				best_node_gap = test_gap
+				best_node = i
+
+	cache[1][ target_node ] = best_node
 	return best_node
 
 
 
+# Check if the old tags1 should be kept for the given key instead of the new value.
+# One rule per key; only consulted for the keys in update_rule_keys.
+
+def keep_old_tag (key, value, tags1):
+
+	if key == "name":
+		return ("name" in tags1 and
+				("bridge" in tags1 and ("bru" in tags1["name"].lower() or "bro" in tags1["name"].lower()) or
+				("tunnel" in tags1 and ("tunnel" in tags1["name"] or "port" in tags1['name'].lower() or "lokk" in tags1['name'].lower()))))
+
+	elif key == "bridge:description":
+		return "name" in tags1 and (tags1['name'] == value and "bru" in value or tags1['name'] == value + " bru")
+
+	elif key == "tunnel:name":
+		return "name" in tags1 and tags1['name'] == value
+
+	elif key == "bridge":
+		return "bridge" in tags1
+
+	elif key == "tunnel":
+		return "tunnel" in tags1
+
+	elif key == "layer":
+		return "layer" in tags1 and ("-" in value) == ("-" in tags1['layer'])
+
+	elif key == "maxspeed":
+		return "maxspeed:forward" in tags1 or "maxspeed:backward" in tags1
+
+	else:  # cycleway
+		return "cycleway:right" in tags1 or "cyclway:left" in tags1
+
+#	elif key == "surface":
+#		return value == "asphalt"
+
+update_rule_keys = frozenset(["name", "bridge:description", "tunnel:name", "bridge", "tunnel", "layer", "maxspeed", "cycleway"])
+
+
+
 # Get the new tags, given tags1 as old tags and tags2 as new/target tags.
 # Several exceptions to avoid undesired deletions or inclusions.
 
@@ -858,33 +1555,73 @@ def update_tags(tags1, tags2):
 				target_tags[key] = value
 
 	for key, value in iter(target_tags.items()):
-		if (key not in avoid_update_tags and ":lanes" not in key and "|" not in value and
-				":forward" not in key and ":backward" not in key and ":left" not in key and ":right" not in key and
-				not (key == "name" and "name" in tags1 and
-					("bridge" in tags1 and ("bru" in tags1["name"].lower() or "bro" in tags1["name"].lower()) or
-					("tunnel" in tags1 and ("tunnel" in tags1["name"] or "port" in tags1['name'].lower() or "lokk" in tags1['name'].lower())))) and
-				not (key == "bridge:description" and "name" in tags1 and
-					(tags1['name'] == value and "bru" in value or tags1['name'] == value + " bru")) and
-				not (key == "tunnel:name" and "name" in tags1 and tags1['name'] == value) and
-				not (key == "bridge" and "bridge" in tags1) and
-				not (key == "tunnel" and "tunnel" in tags1) and
-				not (key == "layer" and "layer" in tags1 and ("-" in value) == ("-" in tags1['layer'])) and
-				not (key == "maxspeed" and ("maxspeed:forward" in tags1 or "maxspeed:backward" in tags1)) and
-				not (key == "cycleway" and ("cycleway:right" in tags1 or "cyclway:left" in tags1))):
-#				not (key == "surface" and value == "asphalt"):
-
-			new_tags[ key ] = value
+		if key in avoid_update_tags or "|" in value:
+			continue
+		if ":" in key and any(suffix in key for suffix in avoid_update_suffixes):
+			continue
+		if key in update_rule_keys and keep_old_tag(key, value, tags1):
+			continue
+
+		new_tags[ key ] = value
 
 	return new_tags
 
 
 
+# Identify the closest matching public NVDB way for one segment, by index into segments.
+# Read-only on the global data sets, so it can run in worker processes which inherit them through fork.
+# Returns (segment_index, best_distance, match_nodes, match_nvdb).
+
+def match_segment (segment_index):
+
+	segment = segments[ segment_index ]
+	osm_way = osm_ways[ segment['id'] ]
+
+	best_distance = 9999
+	match_nodes = []
+	match_nvdb = None
+
+	for nvdb_id, nvdb_way in get_index_ways(nvdb_way_index, public_nvdb_ways, \
+								osm_way['min_lat'], osm_way['max_lat'], osm_way['min_lon'], osm_way['max_lon']):
+		if (nvdb_way['length'] > margin_tag or segment['length'] < margin_tag) and \
+				osm_way['min_lat'] <= nvdb_way['max_lat'] and osm_way['max_lat'] >= nvdb_way['min_lat'] and \
+				osm_way['min_lon'] <= nvdb_way['max_lon'] and osm_way['max_lon'] >= nvdb_way['min_lon']:
+
+			# Match start and end node of NVDB way to limit matching area
+
+			node1 = closest_node(segment, nvdb_way['nodes'][0])
+			node2 = closest_node(segment, nvdb_way['nodes'][-1])
+
+			if node1 != None and node2 != None and nvdb_way['nodes'][0] != nvdb_way['nodes'][-1]:
+				start_node = min(node1, node2)
+				end_node = max(node1, node2)
+			else:
+				start_node = 0
+				end_node = len(nvdb_way['nodes']) - 1
+
+			# Iterate all nodes in nvdb_way and identify average distance from node to osm_way
+			test_distance, test_nodes = match_ways(segment, nvdb_way, start_node, end_node, 2 * margin_tag, trim_end=True)
+
+			if len(test_nodes) >= min_nodes and test_distance < best_distance:
+				cum_lengths = way_cumulative_lengths(segment)
+				test_length = cum_lengths[ test_nodes[-1] ] - cum_lengths[ test_nodes[0] ]
+
+				# Avoid very short segments + avoid matching to almost perpendicular highway
+				if test_length > margin_tag or segment['length'] <= margin_tag:
+					best_distance = test_distance
+					match_nodes = test_nodes
+					match_nvdb = nvdb_id
+
+	return segment_index, best_distance, match_nodes, match_nvdb
+
+
+
 # Update tagging of public highways containing the ref=* tag, without replacing geometry.
 # OSM ways are split to match the NVDB ways, then concatenated if tags are equal.
 
 def tag_highways():
 
-	global new_id
+	global new_id, public_nvdb_ways, nvdb_way_index
 
 	message ("Match and retag highways ...\n")
 
@@ -901,10 +1638,10 @@ def tag_highways():
 				'highway': osm_way['highway'],
 				'ref': ref,
 				'length': osm_way['length'],
-				'nodes': copy.copy(osm_way['nodes']),
-				'tags': copy.copy(osm_way['tags']),
-				'new_tags': copy.copy(osm_way['tags']),
-				'relations': copy.copy(osm_way['relations'])
+				'nodes': list(osm_way['nodes']),
+				'tags': dict(osm_way['tags']),
+				'new_tags': dict(osm_way['tags']),
+				'relations': set(osm_way['relations'])
 			}
 			segments.append(segment)
 			segment_groups[ osm_id ] = [ segment ]  # Will contain split segments in order
@@ -912,8 +1649,9 @@ def tag_highways():
 	# Identify start/end nodes of public highways
 
 	osm_public_end_nodes = {}  # Used later when combining segments
+	public_state_highway = frozenset(public_highway + state_highway)
 	for osm_id, osm_way in iter(osm_ways.items()):
-		if osm_way['highway'] != None and osm_way['highway'] in public_highway + state_highway and not osm_way['incomplete']:
+		if osm_way['highway'] != None and osm_way['highway'] in public_state_highway and not osm_way['incomplete']:
 			for node_id in [ osm_way['nodes'][0], osm_way['nodes'][-1] ]:
 				if node_id not in osm_public_end_nodes:
 					osm_public_end_nodes[ node_id ] = 1
@@ -928,9 +1666,13 @@ def tag_highways():
 
 	# Insert end nodes from NVDB to simplify later matching
 
-	for end_node in nvdb_public_end_nodes:
-		for segment in segments:
-			osm_way = osm_ways[ segment['id'] ]
+	end_node_index = build_node_index(nvdb_public_end_nodes)
+
+	for segment in segments:
+		osm_way = osm_ways[ segment['id'] ]
+
+		for end_node in get_index_nodes(end_node_index, nvdb_public_end_nodes, \
+										osm_way['min_lat'], osm_way['max_lat'], osm_way['min_lon'], osm_way['max_lon']):
 
 			if 	osm_way['min_lat'] <= nodes[ end_node ]['lat'] <= osm_way['max_lat']  and \
 				osm_way['min_lon'] <= nodes[ end_node ]['lon'] <= osm_way['max_lon']:
@@ -939,18 +1681,28 @@ def tag_highways():
 
 				best_distance = margin
 
-				prev_node = segment['nodes'][0]
-				for i, node in enumerate(segment['nodes'][1:]):
-					line_lat, line_lon, node_distance = line_distance(nodes[prev_node]['lat'], nodes[prev_node]['lon'], \
-															nodes[node]['lat'], nodes[node]['lon'], \
-															nodes[end_node]['lat'], nodes[end_node]['lon'])
-					if node_distance < best_distance:
-						best_distance = node_distance
-						best_node = i + 1
+				segment_nodes = segment['nodes']
+				end_node_entry = nodes[ end_node ]
+
+				if numpy_available:
+					line_lat, line_lon, gap_distance, position = closest_way_point_numpy(segment, end_node_entry)
+					if gap_distance < best_distance:
+						best_distance = gap_distance
+						best_node = position
 						best_lat = line_lat
 						best_lon = line_lon
-
-					prev_node = node
+				else:
+					prev_entry = nodes[ segment_nodes[0] ]
+					for i in range(1, len(segment_nodes)):
+						node_entry = nodes[ segment_nodes[i] ]
+						line_lat, line_lon, gap_distance = line_distance_nodes(prev_entry, node_entry, end_node_entry)
+						if gap_distance < best_distance:
+							best_distance = gap_distance
+							best_node = i
+							best_lat = line_lat
+							best_lon = line_lon
+
+						prev_entry = node_entry
 
 				# Insert node if gap to next existing node is big enough
 
@@ -962,26 +1714,30 @@ def tag_highways():
 
 					if dist1 > margin_tag and dist2 > margin_tag:
 						new_id -= 1
+						new_node_id = str(new_id)
 						best_lat = round(best_lat, 7)
 						best_lon = round(best_lon, 7)
 
-						nodes[ str(new_id) ] = {
-							'xml': None,  # To be created at the end of this function
-							'used': 1,      # Note: Not maintained for these nodes
-							'lat': best_lat,
-							'lon': best_lon
-						}
-						segment['nodes'].insert(best_node, str(new_id))
+						add_node (new_node_id, best_lat, best_lon, None, 1)  # XML created at the end of this function;
+						segment['nodes'].insert(best_node, new_node_id)     # 'used' not maintained for these nodes
 
-	# Remove from NVDB short bridges which crosses a tunnel, or vice versa for tunnels
+	# Remove from NVDB short bridges which crosses a tunnel, or vice versa for tunnels.
+	# Only OSM bridges/tunnels can qualify, so prefilter them and query by bounding box;
+	# candidates are checked in load order to keep the original first-crossing marking.
+
+	bridge_tunnel_ways = { osm_id: osm_way for osm_id, osm_way in iter(osm_ways.items()) \
+							if ("tunnel" in osm_way['tags'] or "bridge" in osm_way['tags']) and osm_way['nodes'] }
+	bridge_tunnel_order = { osm_id: i for i, osm_id in enumerate(bridge_tunnel_ways) }
+	bridge_tunnel_index = build_way_index(bridge_tunnel_ways)
 
 	count = 0
 	for nvdb_id, nvdb_way in iter(nvdb_ways.items()):
 		if "tunnel" in nvdb_way['tags'] or "bridge" in nvdb_way['tags'] and nvdb_way['nodes'] and nvdb_way['length'] < 50:
-			for osm_id, osm_way in iter(osm_ways.items()):
+			for osm_id, osm_way in sorted(get_index_ways(bridge_tunnel_index, bridge_tunnel_ways, \
+										nvdb_way['min_lat'], nvdb_way['max_lat'], nvdb_way['min_lon'], nvdb_way['max_lon']), \
+									key = lambda candidate: bridge_tunnel_order[ candidate[0] ]):
 				if ("tunnel" in nvdb_way['tags'] and "bridge" in osm_way['tags'] or \
-						"bridge" in nvdb_way['tags'] and "tunnel" in osm_way['tags']) and \
-						osm_way['nodes']:  # and osm_way['length'] < 50:
+						"bridge" in nvdb_way['tags'] and "tunnel" in osm_way['tags']):  # and osm_way['length'] < 50:
 					if crossing_lines([ nodes[ nvdb_way['nodes'][0] ], nodes[ nvdb_way['nodes'][-1] ]], \
 										[ nodes[ osm_way['nodes'][0] ], nodes[ osm_way['nodes'][-1] ]]):
 
@@ -993,140 +1749,192 @@ def tag_highways():
 
 	message ("\tSwapped %i intersecting bridges/tunnels\n" % count)
 
-	# Match segments
+	# Match segments.
+	# Index only the public NVDB highways; the other classes never pass the candidate filter.
 
 	count_first_match = 0
 
-	segment_index = 0
-	while segment_index < len(segments):
-		segment = segments[ segment_index ]
-		osm_way = osm_ways[ segment['id'] ]
-		segment_index += 1
-		message ("\r%i " % (len(segments) - segment_index))
-
-		best_distance = 9999
-		match_nodes = []
-		match_nvdb = None
-		nvdb_ref = None
+	public_nvdb_ways = { nvdb_id: nvdb_way for nvdb_id, nvdb_way in iter(nvdb_ways.items()) \
+							if nvdb_way['highway'] in public_highway and nvdb_way['highway'] != "service" }
+	nvdb_way_index = build_way_index(public_nvdb_ways)
 
-		# First identify the closest match, disregarding ref=*
+	# Matching is read-only per segment, so each wave of segments is matched in parallel
+	# processes when large enough (split halves form the next wave), while the splits
+	# themselves are applied serially in input order, same as the old sequential loop.
 
-		for nvdb_id, nvdb_way in iter(nvdb_ways.items()):
-			if nvdb_way['highway'] in public_highway and nvdb_way['highway'] != "service" and \
-					(nvdb_way['length'] > margin_tag or segment['length'] < margin_tag) and \
-					osm_way['min_lat'] <= nvdb_way['max_lat'] and osm_way['max_lat'] >= nvdb_way['min_lat'] and \
-					osm_way['min_lon'] <= nvdb_way['max_lon'] and osm_way['max_lon'] >= nvdb_way['min_lon']:
-
-				# Match start and end node of NVDB way to limit matching area
+	wave = list(range(len(segments)))
 
-				node1 = closest_node(segment, nvdb_way['nodes'][0])
-				node2 = closest_node(segment, nvdb_way['nodes'][-1])
+	while wave:
 
-				if node1 != None and node2 != None and nvdb_way['nodes'][0] != nvdb_way['nodes'][-1]:
-					start_node = min(node1, node2)
-					end_node = max(node1, node2)
-				else:
-					start_node = 0
-					end_node = len(nvdb_way['nodes']) - 1
-
-				# Iterate all nodes in nvdb_way and identify average distance from node to osm_way
-				test_distance, test_nodes = match_ways(segment, nvdb_way, start_node, end_node, 2 * margin_tag, trim_end=True)
-
-				if len(test_nodes) >= min_nodes and test_distance < best_distance:
-					test_length = way_length(segment['nodes'][ test_nodes[0] : test_nodes[-1] + 1 ])
-
-					# Avoid very short segments + avoid matching to almost perpendicular highway
-					if test_length > margin_tag or segment['length'] <= margin_tag:
-						best_distance = test_distance
-						match_nodes = test_nodes
-						match_nvdb = nvdb_id
-
-		if match_nvdb and nvdb_ways[match_nvdb]['ref']:
-			nvdb_ref = nvdb_ways[match_nvdb]['ref'].split(";")[0]  # Avoid "Ring" ref
-
-		# No match if too few matched nodes, if wrong ref or across roundabout.
-		# Otherwise calculate length of matched segment to check if sufficiently long.
-
-		if best_distance < margin_tag and (nvdb_ref in segment['ref'] or not force_ref) and \
- 				("junction" in segment['tags'] and segment['tags']['junction'] == "roundabout") == \
-				("junction" in nvdb_ways[match_nvdb]['tags'] and nvdb_ways[match_nvdb]['tags']['junction'] == "roundabout"):
-
-			start_length = way_length(segment['nodes'][ : match_nodes[0] + 1])
-			match_length = way_length(segment['nodes'][ match_nodes[0] : match_nodes[-1] + 1 ])
-			end_length = way_length(segment['nodes'][ match_nodes[-1] : ])
-
-			if match_length > margin_tag or segment['length'] <= margin_tag:
-
-				segment_group = segment_groups[ segment['id'] ]
-				segment_group_index = segment_group.index(segment)
-				segment_nodes = copy.copy(segment['nodes'])
-
-				# Split segment at the start
-				if start_length > margin_tag:
-					new_segment = copy.deepcopy(segment)
-					new_segment['nodes'] = segment_nodes[ : match_nodes[0] + 1]
-					new_segment['length'] = start_length
-					segments.insert(segment_index, new_segment)
-					segment['nodes'] = segment['nodes'][ match_nodes[0] : ]
-					segment['length'] -= start_length
-					if start_length > match_length and start_length > end_length:
-						segment['new'] = True
-					else:
-						new_segment['new'] = True
-
-					segment_group.insert(segment_group_index, new_segment)  # Insert before
-					segment_group_index += 1
-
-				# Split segment at the end
-				if end_length > margin_tag:
-					new_segment = copy.deepcopy(segment)
-					new_segment['nodes'] = segment_nodes[ match_nodes[-1] : ]
-					new_segment['length'] = end_length
-					segments.insert(segment_index, new_segment)
-					segment['nodes'] = segment['nodes'][ : 1 - len(new_segment['nodes']) ]
-					segment['length'] -= end_length
-					if end_length > match_length:
-						segment['new'] = True
-					else:
-						new_segment['new'] = True
+		if "fork" in multiprocessing.get_all_start_methods() and not debug_gap and len(wave) > parallel_threshold:
+			chunk = max(10, len(wave) // (multiprocessing.cpu_count() * 8))  # A few chunks per worker for load balancing
+			with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork")) as executor:
+				wave_results = list(executor.map(match_segment, wave, chunksize=chunk))
+		else:
+			wave_results = [ match_segment(segment_index) for segment_index in wave ]
+
+		new_segments = []  # Split halves, matched in the next wave
+		shift = 0  # Number of splits inserted into segments so far in this wave
+
+		for wave_index, best_distance, match_nodes, match_nvdb in wave_results:
+			segment_index = wave_index + shift + 1  # Position after the segment, like the old loop counter
+			segment = segments[ segment_index - 1 ]
+			message ("\r%i " % (len(segments) - segment_index))
+
+			nvdb_ref = None
+
+			if match_nvdb and nvdb_ways[match_nvdb]['ref']:
+				nvdb_ref = nvdb_ways[match_nvdb]['ref'].split(";")[0]  # Avoid "Ring" ref
+
+			# No match if too few matched nodes, if wrong ref or across roundabout.
+			# Otherwise calculate length of matched segment to check if sufficiently long.
+
+			if best_distance < margin_tag and (not force_ref or nvdb_ref in segment['ref']) and \
+					("junction" in segment['tags'] and segment['tags']['junction'] == "roundabout") == \
+					("junction" in nvdb_ways[match_nvdb]['tags'] and nvdb_ways[match_nvdb]['tags']['junction'] == "roundabout"):
+
+				cum_lengths = way_cumulative_lengths(segment)
+				start_length = cum_lengths[ match_nodes[0] ]
+				match_length = cum_lengths[ match_nodes[-1] ] - cum_lengths[ match_nodes[0] ]
+				end_length = cum_lengths[-1] - cum_lengths[ match_nodes[-1] ]
+
+				if match_length > margin_tag or segment['length'] <= margin_tag:
+
+					segment_group = segment_groups[ segment['id'] ]
+					segment_group_index = segment_group.index(segment)
+					segment_nodes = list(segment['nodes'])
+
+					# Split segment at the start
+					if start_length > margin_tag:
+						new_segment = segment.copy()  # Shallow copy; only nodes and tags need to be independent
+						new_segment['tags'] = dict(segment['tags'])
+						new_segment['new_tags'] = dict(segment['new_tags'])
+						new_segment['nodes'] = segment_nodes[ : match_nodes[0] + 1]
+						new_segment['length'] = start_length
+						segments.insert(segment_index, new_segment)
+						shift += 1
+						new_segments.append(new_segment)
+						segment['nodes'] = segment['nodes'][ match_nodes[0] : ]
+						segment['length'] -= start_length
+						if start_length > match_length and start_length > end_length:
+							segment['new'] = True
+						else:
+							new_segment['new'] = True
+
+						segment_group.insert(segment_group_index, new_segment)  # Insert before
+						segment_group_index += 1
+
+					# Split segment at the end
+					if end_length > margin_tag:
+						new_segment = segment.copy()  # Shallow copy; only nodes and tags need to be independent
+						new_segment['tags'] = dict(segment['tags'])
+						new_segment['new_tags'] = dict(segment['new_tags'])
+						new_segment['nodes'] = segment_nodes[ match_nodes[-1] : ]
+						new_segment['length'] = end_length
+						segments.insert(segment_index, new_segment)
+						shift += 1
+						new_segments.append(new_segment)
+						segment['nodes'] = segment['nodes'][ : 1 - len(new_segment['nodes']) ]
+						segment['length'] -= end_length
+						if end_length > match_length:
+							segment['new'] = True
+						else:
+							new_segment['new'] = True
+
+						segment_group.insert(segment_group_index + 1, new_segment)  # Insert after
+
+					segment['nvdb_id'] = match_nvdb
+					segment['new_tags'] = segment['tags']
+					segment['new_tags'].update(update_tags(segment['tags'], nvdb_ways[ match_nvdb ]['tags']))
+					count_first_match += 1
+
+			segment['distance'] = best_distance
+			segment['order'] = segment_index
+
+		# Split halves are matched in the next wave, in list order like the sequential loop
+
+		if new_segments:
+			positions = { id(segment): i for i, segment in enumerate(segments) }
+			wave = sorted(positions[ id(segment) ] for segment in new_segments)
+		else:
+			wave = []
 
-					segment_group.insert(segment_group_index + 1, new_segment)  # Insert after
 
-				segment['nvdb_id'] = match_nvdb
-				segment['new_tags'] = segment['tags']
-				segment['new_tags'].update(update_tags(segment['tags'], nvdb_ways[ match_nvdb ]['tags']))
-				count_first_match += 1
+	# Try to combine segments with identical tags
 
-		segment['distance'] = best_distance
-		segment['order'] = segment_index
+	# Map end nodes to segments so the neighbour merge below can look up candidates
+	# directly instead of scanning the full segment list per group. The map is kept
+	# in sync as merges change segment end nodes; candidates are sorted by original
+	# list position so the winner is the same segment the linear scan would have found.
 
+	segment_position = {}
+	segment_end_map = {}
 
-	# Try to combine segments with identical tags
+	for i, segment in enumerate(segments):
+		segment_position[ id(segment) ] = i
+		segment['tags_hash'] = hash(frozenset(segment['new_tags'].items()))  # Short-circuits most tag comparisons below
+		for node in set([ segment['nodes'][0], segment['nodes'][-1] ]):
+			if node in segment_end_map:
+				segment_end_map[ node ].append(segment)
+			else:
+				segment_end_map[ node ] = [ segment ]
+
+	def drop_segment_ends(segment):
+		for node in set([ segment['nodes'][0], segment['nodes'][-1] ]):
+			segment_end_map[ node ] = [ s for s in segment_end_map[ node ] if s is not segment ]
+
+	def move_segment_ends(segment, old_end1, old_end2):
+		old_ends = set([ old_end1, old_end2 ])
+		new_ends = set([ segment['nodes'][0], segment['nodes'][-1] ])
+		for node in old_ends - new_ends:
+			segment_end_map[ node ] = [ s for s in segment_end_map[ node ] if s is not segment ]
+		for node in new_ends - old_ends:
+			if node in segment_end_map:
+				segment_end_map[ node ].append(segment)
+			else:
+				segment_end_map[ node ] = [ segment ]
 
 	for osm_id, segment_group in iter(segment_groups.items()):
 
 		# Restore/merge segments within same group which have same tags
 
+		# Match state is computed once per segment and carried over to the next iteration,
+		# instead of re-evaluating the same membership tests for last_segment every time
+
 		last_segment = segment_group[0]
+		last_short = ("nvdb_id" not in last_segment or "new" in last_segment) and last_segment['length'] < margin
+		last_core_tags = ("tunnel" in last_segment['new_tags'], "bridge" in last_segment['new_tags'], "maxheight" in last_segment['new_tags'])
+
 		for segment in segment_group[1:]:
-			if not debug and (segment['new_tags'] == last_segment['new_tags'] or \
-					(("nvdb_id" not in segment or "new" in segment) and segment['length'] < margin or \
-					("nvdb_id" not in last_segment or "new" in last_segment) and last_segment['length'] < margin) and \
-						all((key in segment['new_tags']) == (key in last_segment['new_tags']) for key in ["tunnel", "bridge", "maxheight"])):
+			short = ("nvdb_id" not in segment or "new" in segment) and segment['length'] < margin
+			core_tags = ("tunnel" in segment['new_tags'], "bridge" in segment['new_tags'], "maxheight" in segment['new_tags'])
+
+			if not debug and (segment['tags_hash'] == last_segment['tags_hash'] and segment['new_tags'] == last_segment['new_tags'] or \
+					(short or last_short) and core_tags == last_core_tags):
 
+				old_end = last_segment['nodes'][-1]
+				drop_segment_ends(segment)
 				last_segment['nodes'] += segment['nodes'][1:]
+				move_segment_ends(last_segment, last_segment['nodes'][0], old_end)
 				if not "new" in segment and "new" in last_segment:
 					del last_segment['new']
 				if "nvdb_id" in segment and ("nvdb_id" not in last_segment or segment['length'] > last_segment['length']):
 					last_segment['nvdb_id'] = segment['nvdb_id']
 					last_segment['distance'] = segment['distance']
 					last_segment['new_tags'] = segment['new_tags']
+					last_segment['tags_hash'] = segment['tags_hash']
 
 				last_segment['length'] += segment['length']
-				segments.remove(segment)
-				segment_group.remove(segment)
+				segment['remove'] = True  # Compacted below; avoids O(n) list removals
+
+				last_short = ("nvdb_id" not in last_segment or "new" in last_segment) and last_segment['length'] < margin
+				last_core_tags = ("tunnel" in last_segment['new_tags'], "bridge" in last_segment['new_tags'], "maxheight" in last_segment['new_tags'])
 			else:
 				last_segment = segment
+				last_short = short
+				last_core_tags = core_tags
+
+		segment_group[:] = [ segment for segment in segment_group if "remove" not in segment ]
 
 		# Check if new segment could be merge with segment from neighbour group.
 		# If the new segment is shorter than a margin, then it will get the tags of its neighbour.
@@ -1136,12 +1944,17 @@ def tag_highways():
 			if "new" in segment1 and (segment1['nodes'][ position ] not in osm_public_end_nodes or \
 					osm_public_end_nodes[ segment1['nodes'][ position ] ] == 2) and not debug:
 
-				for segment2 in segments:
-					if segment1['relations'] == segment2['relations'] and \
+				end_node = segment1['nodes'][ position ]
+				candidates = sorted(segment_end_map.get(end_node, []), key = lambda candidate: segment_position[ id(candidate) ])
+
+				for segment2 in candidates:
+					if segment1['tags_hash'] == segment2['tags_hash'] and segment1['relations'] == segment2['relations'] and \
 							segment1['new_tags'] == segment2['new_tags'] and segment1 != segment2:
 							# Note: Old tags might be different. Might be different roles in restriction relations.
 
 						found = False
+						old_end1 = segment2['nodes'][0]
+						old_end2 = segment2['nodes'][-1]
 
 						if position == 0:  # First segment
 							if segment2['nodes'][-1] == segment1['nodes'][0]:
@@ -1157,19 +1970,27 @@ def tag_highways():
 								found = True
 							elif segment2['nodes'][-1] == segment1['nodes'][-1] and "oneway" not in segment1['new_tags']:
 								segment2['nodes'] += segment1['nodes'][::-1][1:]
-								found = True							
+								found = True
 
 						if found:
 							segment2['length'] += segment['length']
-							segment_group.remove(segment1)
-							segments.remove(segment1)
+							drop_segment_ends(segment1)
+							move_segment_ends(segment2, old_end1, old_end2)
+							del segment_group[ position ]
+							segment1['remove'] = True
 							break
 
+	# Compact the global segment list once, after all merges
+
+	segments[:] = [ segment for segment in segments if "remove" not in segment ]
+
 	# Check if new intersection nodes have been used
 
 	count_match = 0
 	count_new_segments = 0
 	count_new_nodes = 0
+	delete_nodes = []
+	new_node_elements = []
 
 	for segment in segments:
 
@@ -1178,7 +1999,7 @@ def tag_highways():
 			new_nodes = [ segment['nodes'][0] ]
 			for node in segment['nodes'][1:-1]:
 				if node[0] == "-":
-					del nodes[ node ]
+					delete_nodes.append(node)
 				else:
 					new_nodes.append(node)
 			new_nodes.append(segment['nodes'][-1])
@@ -1192,15 +2013,18 @@ def tag_highways():
 		for end_node in check_nodes:
 			node = segment['nodes'][end_node]
 			if nodes[node]['xml'] is None:
-				new_node = root_osm.append(ElementTree.Element("node", id=node, action="modify", \
+				new_node_elements.append(ElementTree.Element("node", id=node, action="modify", \
 											lat=str(nodes[node]['lat']), lon=str(nodes[node]['lon'])))
-				nodes[node]['xml'] = new_node	
 				count_new_nodes += 1
 
 		if "new" in segment:
 			count_new_segments += 1
 		if "nvdb_id" in segment:
-			count_match += 1			
+			count_match += 1
+
+	root_osm.extend(new_node_elements)  # One batch append instead of per-node inserts
+	for node in delete_nodes:
+		del nodes[ node ]
 
 	message ("\r  \tMatched %i highway segments, %i not matched\n" % (count_match, len(segments) - count_match))
 	message ("\tAdded %i new highway segments\n" % count_new_segments)
@@ -1211,19 +2035,59 @@ def tag_highways():
 # Indent XML output
 
 def indent_tree(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_tree(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+
+	indent = "\n" + level * "  "
+
+	if not len(elem):
+		if level and (not elem.tail or not elem.tail.strip()):
+			elem.tail = indent
+		return
+
+	if not elem.text or not elem.text.strip():
+		elem.text = indent + "  "
+	if not elem.tail or not elem.tail.strip():
+		elem.tail = indent
+
+	stack = [ (elem, indent) ]
+	while stack:
+		element, indent = stack.pop()
+		child_indent = indent + "  "
+		last_child = element[-1]
+
+		for child in element:
+			if len(child):
+				if not child.text or not child.text.strip():
+					child.text = child_indent + "  "
+				stack.append(( child, child_indent ))
+			if not child.tail or not child.tail.strip():
+				if child is last_child:
+					child.tail = indent  # Last child closes at the parent's level
+				else:
+					child.tail = child_indent
+
+
+
+# Write OSM XML to file, streaming one top level element at a time instead of serializing
+# the whole tree in one pass. Elements are cleared once written to keep memory flat.
+
+def write_osm_file (filename):
+
+	with open(filename, "wb", buffering = 1024 * 1024) as file:
+		file.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+		file.write(("<osm %s>" % " ".join('%s="%s"' % (key, value) \
+					for key, value in iter(root_osm.attrib.items()))).encode("utf-8"))
+
+		elements = list(root_osm)
+		if elements:
+			file.write(b"\n  ")
+			for i, element in enumerate(elements):
+				indent_tree(element, 1)
+				if i == len(elements) - 1:
+					element.tail = "\n"
+				ElementTree.ElementTree(element).write(file, encoding="utf-8", xml_declaration=False)
+				element.clear()
+
+		file.write(b"</osm>\n")
 
 
 
@@ -1235,24 +2099,36 @@ def update_relations():
 
 	updated_relations = set()
 
+	# Build lookup tables once to avoid scanning the XML tree per segment group
+
+	relation_index = {}
+	for relation in root_osm.iter("relation"):
+		relation_index[ relation.attrib['id'] ] = relation
+
+	way_end_nodes = {}
+	for way_id, way in iter(osm_ways.items()):
+		if "nodes" in way and way['nodes']:
+			way_end_nodes[ way_id ] = set([ way['nodes'][0], way['nodes'][-1] ])
+
 	for osm_id, segment_group in iter(segment_groups.items()):
 
 		if len(segment_group) < 2:
 			continue
 
 		for relation_id in segment_group[0]['relations']:
-			relation = root_osm.find("relation[@id='%s']" % relation_id)
+			relation = relation_index.get(relation_id)
 			if relation is None:
 				continue
 
 			# Get relation members and position of original way
 
 			members = []
+			member_elems = relation.findall("member")
 			group_members = [segment['id'] for segment in segment_group]
 			position = None
 			via = None
 
-			for member in relation.findall("member"):
+			for member in member_elems:
 				members.append(member.attrib['ref'])
 				if "role" in member.attrib and member.attrib['role'] == "via":
 					via = member.attrib['ref']
@@ -1268,17 +2144,15 @@ def update_relations():
 					segment_start = set({ segment_group[0]['nodes'][0], segment_group[0]['nodes'][-1] })
 					segment_end = set({ segment_group[-1]['nodes'][0], segment_group[-1]['nodes'][-1] })
 
-					if position == 0 or members[position-1] not in osm_ways or \
-							"nodes" not in osm_ways[members[position-1]] or not osm_ways[members[position-1]]['nodes']:
+					if position == 0:
 						member_before = set()
 					else:
-						member_before = set({ osm_ways[members[position-1]]['nodes'][0], osm_ways[members[position-1]]['nodes'][-1] })
-				
-					if position == len(members) - 1 or members[position+1] not in osm_ways or \
-							"nodes" not in osm_ways[members[position+1]] or not osm_ways[members[position+1]]['nodes']:
+						member_before = way_end_nodes.get(members[ position - 1 ], set())
+
+					if position == len(members) - 1:
 						member_after = set()
 					else:
-						member_after = set({ osm_ways[members[position+1]]['nodes'][0], osm_ways[members[position+1]]['nodes'][-1] })
+						member_after = way_end_nodes.get(members[ position + 1 ], set())
 
 					if segment_start.intersection(member_before) and segment_end.intersection(member_after):
 						new_members = group_members
@@ -1301,20 +2175,24 @@ def update_relations():
 
 					# Insert into relation member list (may have been modified during while loop)
 
-					for i, member in enumerate(relation.findall("member")):
-						if i == position:
-							if "role" in member.attrib:
-								role = member.attrib['role']  # All group members will inherit role
-							else:
-								role = None
-							relation.remove(member)
-							for new_member in reversed(new_members):
-								if role:
-									relation.insert(i, ElementTree.Element("member", type="way", ref=str(new_member), role=role))
-								else:
-									relation.insert(i, ElementTree.Element("member", type="way", ref=str(new_member)))
-								updated_relations.add(relation_id)
-							break							
+					member = member_elems[ position ]
+					if "role" in member.attrib:
+						role = member.attrib['role']  # All group members will inherit role
+					else:
+						role = None
+
+					new_elems = []
+					for new_member in new_members:
+						if role:
+							new_elems.append(ElementTree.Element("member", type="way", ref=str(new_member), role=role))
+						else:
+							new_elems.append(ElementTree.Element("member", type="way", ref=str(new_member)))
+						updated_relations.add(relation_id)
+
+					relation.remove(member)
+					for new_elem in reversed(new_elems):
+						relation.insert(position, new_elem)
+					member_elems[ position : position + 1 ] = new_elems
 
 					relation.set("action", "modify")
 					members = members[ : position ] + new_members + members[ position + 1 : ]
@@ -1339,25 +2217,27 @@ def count_updated_tags(key):
 
 
 
+# True if tag should be removed
+
+def remove_tags(key, value, tags):
+
+	return (key in delete_tags
+			or key in delete_negative_tags and value in ("no", "none")
+			or "source" in key
+			or key == "maxheight" and value == "default"
+			or key == "lanes" and "junction" not in tags
+				and (("oneway" not in tags or tags['oneway'] == "no")
+						and value in ("1", "2") and "turn:lanes:forward" not in tags and "turn:lanes:backward" not in tags
+					or "oneway" in tags and tags['oneway'] == "yes" and value == "1" and "turn:lanes" not in tags))
+
+
+
 # Update tagging in XML
 
 def update_xlm_tags(way, osm_id):
 
 	global count_modified_tag
 
-	# True if tag should be removed
-	def remove_tags(key, value, tags):
-
-		return (key in delete_tags
-				or key in delete_negative_tags and value in ["no", "none"]
-				or "source" in key
-				or key == "maxheight" and value == "default"
-				or key == "lanes" and "junction" not in tags
-					and (("oneway" not in tags or tags['oneway'] == "no")
-							and value in ["1", "2"] and "turn:lanes:forward" not in tags and "turn:lanes:backward" not in tags
-						or "oneway" in tags and tags['oneway'] == "yes" and value == "1" and "turn:lanes" not in tags))
-
-	# Main function
 	if "nvdb_id" in osm_ways[ osm_id ]:
 		modified_tags = []
 		consider_tags = []
@@ -1369,6 +2249,7 @@ def update_xlm_tags(way, osm_id):
 		new_tags = update_tags(osm_tags, nvdb_tags)  # Note: Does not contain tags which are prevented from updating (highway, ref etc.)
 
 		# Existing tags in OSM
+		removed_elements = []
 		for tag_osm in way.findall("tag"):
 			key = tag_osm.attrib['k']
 			value = tag_osm.attrib['v']
@@ -1381,7 +2262,7 @@ def update_xlm_tags(way, osm_id):
 
 			elif remove_tags(key, value, osm_tags):
 				modified_tags.append("Removed %s=%s" % (key, value))
-				way.remove(tag_osm)
+				removed_elements.append(tag_osm)
 				count_updated_tags(key)
 
 			elif key not in nvdb_tags:
@@ -1399,10 +2280,13 @@ def update_xlm_tags(way, osm_id):
 #				elif key != key.upper():
 #					diff_tags.append("Remove %s=%s" % (key, value))
 
+		if removed_elements:
+			way[:] = [ element for element in way if element not in removed_elements ]  # Batch removal, one child list rebuild
+
 		# New tags added to OSM
 		for key, value in iter(new_tags.items()):
 			if key not in osm_tags:
-				way.append(ElementTree.Element("tag", k=key, v=value))
+				ElementTree.SubElement(way, "tag", k=key, v=value)
 				modified_tags.append("Added %s=%s" % (key, value))
 				count_updated_tags(key)
 
@@ -1438,29 +2322,33 @@ def update_xlm_tags(way, osm_id):
 			count_modified_tag += 1
 			if modified_tags:
 				way.set("action", "modify")
-				way.append(ElementTree.Element("tag", k="EDIT", v="; ".join(sorted(modified_tags))))
+				ElementTree.SubElement(way, "tag", k="EDIT", v="; ".join(sorted(modified_tags)))
 			if consider_tags:
-				way.append(ElementTree.Element("tag", k="CONSIDER", v="; ".join(sorted(consider_tags))))
+				ElementTree.SubElement(way, "tag", k="CONSIDER", v="; ".join(sorted(consider_tags)))
 			if diff_tags:
-				way.append(ElementTree.Element("tag", k="DIFF", v="; ".join(sorted(diff_tags))))
+				ElementTree.SubElement(way, "tag", k="DIFF", v="; ".join(sorted(diff_tags)))
 
 	# Only test for tags to remove for non-matched ways
 	else:
 		tags = osm_ways[ osm_id ]['tags']
 		modified_tags = []
-		
+		removed_elements = []
+
 		for tag_osm in way.findall("tag"):
 			key = tag_osm.attrib['k']
 			value = tag_osm.attrib['v']
 			if remove_tags(key, value, tags):
 				modified_tags.append("Removed %s=%s" % (key, value))
-				way.remove(tag_osm)
+				removed_elements.append(tag_osm)
 				count_updated_tags(key)
 
+		if removed_elements:
+			way[:] = [ element for element in way if element not in removed_elements ]
+
 		if modified_tags:
 			count_modified_tag += 1
 			way.set("action", "modify")
-			way.append(ElementTree.Element("tag", k="EDIT", v="; ".join(sorted(modified_tags))))
+			ElementTree.SubElement(way, "tag", k="EDIT", v="; ".join(sorted(modified_tags)))
 
 
 
@@ -1485,17 +2373,18 @@ def output_file (osm_filename):
 		for segment in segments:
 			if "new" in segment:
 				new_id -= 1
-				way = ElementTree.Element("way", id=str(new_id), action="modify")
+				new_way_id = str(new_id)
+				way = ElementTree.Element("way", id=new_way_id, action="modify")
 				root_osm.append(way)
 				for tag in osm_ways[ segment['id'] ]['xml'].findall("tag"):
 					way.append(copy.deepcopy(tag))
-				way.append(ElementTree.Element("tag", k="NEW_SEGMENT", v=segment['id']))
+				ElementTree.SubElement(way, "tag", k="NEW_SEGMENT", v=segment['id'])
 
 				osm_way = copy.deepcopy(osm_ways[ segment['id'] ])
 				osm_way['xml'] = way
-				osm_ways[ str(new_id) ] = osm_way
+				osm_ways[ new_way_id ] = osm_way
 
-				segment['id'] = str(new_id)
+				segment['id'] = new_way_id
 
 		for segment in segments:
 			osm_way = osm_ways[ segment['id'] ]
@@ -1503,83 +2392,102 @@ def output_file (osm_filename):
 
 			if segment['nodes'] != osm_way['nodes']:  # osm_ways[ segment['id'] ]['nodes']:
 				way.set("action", "modify")
-				for node in way.findall("nd"):
-					way.remove(node)
+				way[:] = [ element for element in way if element.tag != "nd" ]  # Batch removal avoids repeated child list shifts
 				for node in segment['nodes']:
-					way.append(ElementTree.Element("nd", ref=node))
+					ElementTree.SubElement(way, "nd", ref=node)
 				osm_way['nodes'] = segment['nodes']
 
 			if "nvdb_id" in segment:
 				osm_way['nvdb_id'] = segment['nvdb_id']
 			else:
-				way.append(ElementTree.Element("tag", k="NO_MATCH", v="yes"))
+				ElementTree.SubElement(way, "tag", k="NO_MATCH", v="yes")
 
 			if debug:
-				way.append(ElementTree.Element("tag", k="DISTANCE", v="%.1f" % segment['distance']))
-				way.append(ElementTree.Element("tag", k="ORDER", v=str(segment['order'])))
+				ElementTree.SubElement(way, "tag", k="DISTANCE", v="%.1f" % segment['distance'])
+				ElementTree.SubElement(way, "tag", k="ORDER", v=str(segment['order']))
 				if "nvdb_id" in segment:
-					way.append(ElementTree.Element("tag", k="NVDBID", v=segment['nvdb_id']))
+					ElementTree.SubElement(way, "tag", k="NVDBID", v=segment['nvdb_id'])
 
 	# Merge NVDB ways with OSM
 
-	for way in root_osm.findall("way"):
+	xml_ways = root_osm.findall("way")  # Snapshot, reused by the later passes instead of re-scanning the tree
+
+	# Command is constant, so resolve the per-way branch tests once
+
+	replace_command = command == "replace"
+	tag_command = command in ["tag", "tagref", "taglocal"]
+	public_tag_command = command in ["tagref", "taglocal"]
+
+	for way in xml_ways:
 		osm_id = way.attrib['id']
+		osm_way = osm_ways[ osm_id ]
 
 		# Replace geometry and tags
 
-		if command == "replace" and "nvdb_id" in osm_ways[ osm_id ]:
+		if replace_command and "nvdb_id" in osm_way:
 
-			nvdb_id = osm_ways[ osm_id ]['nvdb_id'] 
+			nvdb_id = osm_way['nvdb_id']
 			nvdb_way = nvdb_ways[ nvdb_id ]['xml']
 
+			xml_tags = {}  # Tag elements by key, avoiding repeated XML searches
 			for tag_osm in way.findall("tag"):
 				if tag_osm.attrib['k'] in replace_tags:
 					way.remove(tag_osm)
+				else:
+					xml_tags[ tag_osm.attrib['k'] ] = tag_osm
 
 			for tag_nvdb in nvdb_way.iter("tag"):
-				tag_osm = way.find("tag[@k='%s']" % tag_nvdb.attrib['k'])
+				tag_osm = xml_tags.get(tag_nvdb.attrib['k'])
 				if tag_nvdb.attrib['k'] == "highway":
 					if tag_osm != None and tag_nvdb.attrib['v'] != tag_osm.attrib['v']:
-						way.append(ElementTree.Element("tag", k="NVDB", v=tag_nvdb.attrib['v']))
+						ElementTree.SubElement(way, "tag", k="NVDB", v=tag_nvdb.attrib['v'])
 				elif tag_osm != None:
 					tag_osm.set("v", tag_nvdb.attrib['v'])
 				else:
-					way.append(ElementTree.Element("tag", k=tag_nvdb.attrib['k'], v=tag_nvdb.attrib['v']))
+					ElementTree.SubElement(way, "tag", k=tag_nvdb.attrib['k'], v=tag_nvdb.attrib['v'])
 
 			if debug:
-				way.append(ElementTree.Element("tag", k="OSMID", v=osm_id))
-				way.append(ElementTree.Element("tag", k="ORDER", v=str(nvdb_ways[ nvdb_id ]['order'])))
-				way.append(ElementTree.Element("tag", k="DISTANCE", v=str(round(nvdb_ways[ nvdb_id ]['distance']))))
-
-			for node in way.findall('nd'):
-				nodes[ node.attrib['ref'] ]['used'] -= 1
-				way.remove(node)
+				ElementTree.SubElement(way, "tag", k="OSMID", v=osm_id)
+				ElementTree.SubElement(way, "tag", k="ORDER", v=str(nvdb_ways[ nvdb_id ]['order']))
+				ElementTree.SubElement(way, "tag", k="DISTANCE", v=str(round(nvdb_ways[ nvdb_id ]['distance'])))
+
+			keep_elements = []
+			for element in way:
+				if element.tag == "nd":
+					nodes[ element.attrib['ref'] ]['used'] -= 1
+				else:
+					keep_elements.append(element)
+			way[:] = keep_elements
 
 			for node in nvdb_way.iter("nd"):
 				nodes[ node.attrib['ref'] ]['used'] += 1
-				way.append(ElementTree.Element("nd", ref=node.attrib['ref']))
+				ElementTree.SubElement(way, "nd", ref=node.attrib['ref'])
 
 			way.set("action", "modify")
 
 		# Remove way
 
-		elif command == "replace" and "remove" in osm_ways[ osm_id ]:
+		elif replace_command and "remove" in osm_way:
 
-			for node in way.findall('nd'):
-				nodes[ node.attrib['ref'] ]['used'] -= 1
-				way.remove(node)
+			keep_elements = []
+			for element in way:
+				if element.tag == "nd":
+					nodes[ element.attrib['ref'] ]['used'] -= 1
+				else:
+					keep_elements.append(element)
+			way[:] = keep_elements
 
 			way.set("action", "delete")
 
 		# Replace tags only
 
-		elif command in ["tag", "tagref", "taglocal"] and "nvdb_id" in osm_ways[osm_id]:
+		elif tag_command and "nvdb_id" in osm_way:
 			update_xlm_tags(way, osm_id)
 
 		# Remove certain unwanted tags even for segments not matched
 
-		elif command in ["tagref", "taglocal"] and osm_ways[osm_id]['highway'] in public_highway and \
-				(not force_ref or "ref" in osm_ways[osm_id]['tags']) and not osm_ways[osm_id]['incomplete']:
+		elif public_tag_command and osm_way['highway'] in public_highway and \
+				(not force_ref or "ref" in osm_way['tags']) and not osm_way['incomplete']:
 			update_xlm_tags(way, osm_id)
 
 	# Report tagging results
@@ -1604,53 +2512,52 @@ def output_file (osm_filename):
 
 			if command == "offset":
 				if nvdb_ways[ nvdb_id ]['highway'] != osm_ways[ nvdb_ways[nvdb_id]['osm_id'] ]['highway']:
-					tag_highway = way.find("tag[@k='highway']")
+					for tag_highway in way.iter("tag"):
+						if tag_highway.attrib['k'] == "highway":
+							break
 					tag_highway.set("v", osm_ways[ nvdb_ways[nvdb_id]['osm_id'] ]['highway'])
-					way.append(ElementTree.Element("tag", k="NVDB", v=nvdb_ways[ nvdb_id ]['highway']))
+					ElementTree.SubElement(way, "tag", k="NVDB", v=nvdb_ways[ nvdb_id ]['highway'])
 				if debug:
-					way.append(ElementTree.Element("tag", k="OSMID", v=nvdb_ways[ nvdb_id ]['osm_id']))
-					way.append(ElementTree.Element("tag", k="ORDER", v=str(nvdb_ways[ nvdb_id ]['order'])))
-					way.append(ElementTree.Element("tag", k="DISTANCE", v=str(round(nvdb_ways[ nvdb_id ]['distance']))))
+					ElementTree.SubElement(way, "tag", k="OSMID", v=nvdb_ways[ nvdb_id ]['osm_id'])
+					ElementTree.SubElement(way, "tag", k="ORDER", v=str(nvdb_ways[ nvdb_id ]['order']))
+					ElementTree.SubElement(way, "tag", k="DISTANCE", v=str(round(nvdb_ways[ nvdb_id ]['distance'])))
 
 			root_osm.append(way)
+			xml_ways.append(way)
 			for node in nvdb_ways[ nvdb_id ]['nodes']:
 				nodes[ node ]['used'] += 1
 
 			if debug and "missing" in nvdb_ways[ nvdb_id ]:
-				way.append(ElementTree.Element("tag", k="MISSING", v=nvdb_ways[ nvdb_id ]['missing']))
+				ElementTree.SubElement(way, "tag", k="MISSING", v=nvdb_ways[ nvdb_id ]['missing'])
 
-	# Remove OSM nodes which are not used anymore
+	# Remove OSM nodes which are not used anymore.
+	# Iterates the loaded node dicts instead of re-walking the XML tree.
+	# For "new"/"offset" root_osm is a fresh tree without the loaded nodes, so nothing to delete.
 
-	for node in root_osm.iter("node"):
-		node_id = node.attrib['id']
-		tag = node.find("tag")
-
-		if tag == None and nodes[ node_id ]['used'] == 0:
-			node.set("action", "delete")
+	if command not in ["new", "offset"]:
+		for node in nodes.values():
+			if node['used'] == 0 and node['xml'] is not None and node['xml'].find("tag") is None:
+				node['xml'].set("action", "delete")
 
 	# Add new NVDB nodes
+	# Note: List materialized before moving nodes, as lxml reparents elements on append
 
-	for node in root_nvdb.iter("node"):
+	for node in list(root_nvdb.iter("node")):
 		node_id = node.attrib['id']
 		if node_id in nodes and nodes[ node_id ]['used'] > 0:
 			root_osm.append(node)	
 
 	# Remove possible historic NVDB tags from OSM
 
-	for way in root_osm.findall("way"):
-		tag = way.find("tag[@k='nvdb:id']")
-		if tag != None:
-			way.remove(tag)
-			way.set("action", "modify")
-		tag = way.find("tag[@k='nvdb:date']")
-		if tag != None:
-			way.remove(tag)
-			way.set("action", "modify")
-		if "action" in way.attrib and way.attrib['action'] == "modify":  # Also source tag if hit
-			tag = way.find("tag[@k='source']")
-			if tag != None:
-				way.remove(tag)
+	for way in xml_ways:
+		xml_tags = { tag.attrib['k']: tag for tag in way.findall("tag") }  # Avoids repeated XML searches
+		for key in ["nvdb:id", "nvdb:date"]:
+			if key in xml_tags:
+				way.remove(xml_tags[ key ])
 				way.set("action", "modify")
+		if "action" in way.attrib and way.attrib['action'] == "modify" and "source" in xml_tags:  # Also source tag if hit
+			way.remove(xml_tags['source'])
+			way.set("action", "modify")
 
 
 	# Add distance markers for debugging
@@ -1660,17 +2567,17 @@ def output_file (osm_filename):
 		for line in test_lines:
 			way = ElementTree.Element("way", id=str(i), action="modify")
 			root_osm.append(way)
-			root_osm.append(ElementTree.Element("node", id=str(i-1), action="modify", lat=str(line['lat1']), lon=str(line['lon1'])))
-			root_osm.append(ElementTree.Element("node", id=str(i-2), action="modify", lat=str(line['lat2']), lon=str(line['lon2'])))
-			way.append(ElementTree.Element("nd", ref=str(i-1)))
-			way.append(ElementTree.Element("nd", ref=str(i-2)))
-			way.append(ElementTree.Element("tag", k="GAP", v=str(line['distance'])))
+			ElementTree.SubElement(root_osm, "node", id=str(i-1), action="modify", lat=str(line['lat1']), lon=str(line['lon1']))
+			ElementTree.SubElement(root_osm, "node", id=str(i-2), action="modify", lat=str(line['lat2']), lon=str(line['lon2']))
+			ElementTree.SubElement(way, "nd", ref=str(i-1))
+			ElementTree.SubElement(way, "nd", ref=str(i-2))
+			ElementTree.SubElement(way, "tag", k="GAP", v=str(line['distance']))
 			i -= 3
 
 	# Generate list of top contributors for modified highways
 
 	users = {}
-	for way in root_osm.iter("way"):
+	for way in xml_ways:
 		if "action" in way.attrib and way.attrib['action'] == "modify" and "user" in way.attrib:
 			if way.attrib['user'] not in users:
 				users[ way.attrib['user'] ] = 0
@@ -1690,9 +2597,8 @@ def output_file (osm_filename):
 
 	root_osm.set("generator", "highway_merge v"+version)
 	root_osm.set("upload", "false")
-	indent_tree(root_osm)
 	filename_out = filename_osm.replace(" ", "_").replace(".osm", "") + "_%s.osm" % command
-	tree_osm.write(filename_out, encoding='utf-8', method='xml', xml_declaration=True)
+	write_osm_file (filename_out)
 
 	message ("'%s' saved\n" % filename_out)
 
@@ -1801,9 +2707,17 @@ if __name__ == '__main__':
 			continue
 
 		start_time = time.time()
+		tree_osm = None  # Release previous municipality's DOM before parsing the next
+		root_osm = None
+		tree_nvdb = None
+		root_nvdb = None
 		osm_ways = {}
 		nvdb_ways = {}
 		nodes = {}
+		node_latitudes = []
+		node_longitudes = []
+		node_projections = []
+		node_array = None
 		segments = []
 		segment_groups = {}
 		test_lines = []  # For debug